@@ -15,50 +15,205 @@
 
 # Manage jobs in Jenkins server
 
+import base64
 import errno
 import hashlib
 import io
+import json
 import logging
+import multiprocessing
 import operator
 import os
 from pprint import pformat
+import random
 import re
+import socket
+import tempfile
+import threading
 import time
 import xml.etree.ElementTree as XML
 import yaml
 
 import jenkins
+try:
+    from requests.adapters import HTTPAdapter
+    from requests import exceptions as requests_exceptions
+except ImportError:
+    HTTPAdapter = None
+    requests_exceptions = None
+
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows, where the cache is saved without locking
+    fcntl = None
 
 from jenkins_jobs.constants import MAGIC_MANAGE_STRING
+from jenkins_jobs.errors import JenkinsJobsException
+from jenkins_jobs.local_yaml import YamlCache
 from jenkins_jobs.parallel import parallelize
+from jenkins_jobs.parallel import run_adaptive
+from jenkins_jobs.parallel import TaskCancelled
+from jenkins_jobs.parallel import WorkerPool
+from jenkins_jobs.parser import load_yaml_file
 from jenkins_jobs.parser import YamlParser
 from jenkins_jobs import utils
+from jenkins_jobs.xml_config import normalized_md5
 
 
 logger = logging.getLogger(__name__)
 
 _DEFAULT_TIMEOUT = object()
 
+# fetch the description of all the jobs with a single request
+JOBS_DESCRIPTION_QUERY = '?tree=jobs[name,description]'
+
+# create or reconfigure a batch of jobs, given as base64 encoded names and
+# configurations, from the script console, printing the status of each
+BATCH_UPDATE_SCRIPT = """
+import javax.xml.transform.stream.StreamSource
+import jenkins.model.Jenkins
+
+def jobs = [
+%s
+]
+jobs.eachWithIndex { job, i ->
+    try {
+        def name = new String(job[0].decodeBase64(), 'UTF-8')
+        def xml = job[1].decodeBase64()
+        def item = Jenkins.instance.getItemByFullName(name)
+        if (item == null) {
+            def slash = name.lastIndexOf('/')
+            def parent = slash < 0 ? Jenkins.instance :
+                Jenkins.instance.getItemByFullName(name.substring(0, slash))
+            parent.createProjectFromXML(name.substring(slash + 1),
+                                        new ByteArrayInputStream(xml))
+            println "jjb-status ${i} created"
+        } else {
+            item.updateByXml(new StreamSource(new ByteArrayInputStream(xml)))
+            println "jjb-status ${i} updated"
+        }
+    } catch (Throwable e) {
+        println "jjb-status ${i} failed " +
+            e.toString().getBytes('UTF-8').encodeBase64()
+    }
+}
+"""
+BATCH_STATUS_RE = re.compile(
+    r'^jjb-status (\d+) (created|updated|failed)(?: (\S+))?$', re.M)
+
+
+# exceptions raised when Jenkins fails to answer in time
+TIMEOUT_EXCEPTIONS = (socket.timeout,)
+if hasattr(jenkins, 'TimeoutException'):
+    TIMEOUT_EXCEPTIONS += (jenkins.TimeoutException,)
+if requests_exceptions is not None:
+    TIMEOUT_EXCEPTIONS += (requests_exceptions.Timeout,)
+
+# exceptions raised when a request could not reach Jenkins. Other errors of
+# requests, such as HTTPError, are also socket errors on python 3 but would
+# fail the same way when sent again
+CONNECTION_EXCEPTIONS = ()
+if requests_exceptions is not None:
+    CONNECTION_EXCEPTIONS += (requests_exceptions.ConnectionError,)
+
+# exceptions raised when the item requested does not exist in Jenkins
+NOT_FOUND_EXCEPTIONS = ()
+if hasattr(jenkins, 'NotFoundException'):
+    NOT_FOUND_EXCEPTIONS += (jenkins.NotFoundException,)
+
+# statuses answered by Jenkins, or a proxy in front of it, when it is
+# overloaded or restarting. Jenkins also answers 500 when it rejects the
+# configuration of a job, which would fail again
+OVERLOAD_STATUSES = (502, 503, 504)
+
+
+def _status_code(exc):
+    # requests and urllib errors carry the response status code, while
+    # python-jenkins only keeps it in the message of its own exceptions
+    status = getattr(getattr(exc, 'response', None), 'status_code', None)
+    if status is None:
+        status = getattr(exc, 'code', None)
+    if isinstance(status, int):
+        return status
+    match = re.search(r'\[(\d{3})\]', str(exc))
+    if match:
+        return int(match.group(1))
+    return None
+
+
+def is_overload(exc):
+    """Return whether the exception raised by a request to Jenkins shows it
+    is overloaded, being a timeout or a 502, 503 or 504 error.
+    """
+    if isinstance(exc, TIMEOUT_EXCEPTIONS):
+        return True
+    return _status_code(exc) in OVERLOAD_STATUSES
+
+
+def is_transient(exc):
+    """Return whether a request to Jenkins that raised the exception may
+    succeed when sent again, after a connection error or an overload.
+    """
+    return isinstance(exc, CONNECTION_EXCEPTIONS) or is_overload(exc)
+
+
+def is_not_found(exc):
+    """Return whether the exception raised by a request to Jenkins shows the
+    item requested, such as a job, does not exist.
+    """
+    if isinstance(exc, NOT_FOUND_EXCEPTIONS):
+        return True
+    return _status_code(exc) == 404
+
+
+def is_fatal(exc):
+    """Return whether a request to Jenkins that raised the exception would
+    fail the same way for any job, after an authentication or permission
+    error.
+    """
+    return _status_code(exc) in (401, 403)
+
 
 class CacheStorage(object):
     # ensure each instance of the class has a reference to the required
     # modules so that they are available to be used when the destructor
     # is being called since python will not guarantee that it won't have
     # removed global module references during teardown.
-    _yaml = yaml
+    _json = json
     _logger = logger
+    _io = io
+    _os = os
+    _tempfile = tempfile
+    _fcntl = fcntl
 
     def __init__(self, jenkins_url, flush=False):
         cache_dir = self.get_cache_dir()
         # One cache per remote Jenkins URL:
         host_vary = re.sub('[^A-Za-z0-9\-\~]', '_', jenkins_url)
         self.cachefilename = os.path.join(
+            cache_dir, 'cache-host-jobs-' + host_vary + '.json')
+        # cache written by earlier versions, migrated when no json cache
+        # exists yet
+        self.yaml_cachefilename = os.path.join(
             cache_dir, 'cache-host-jobs-' + host_vary + '.yml')
-        if flush or not os.path.isfile(self.cachefilename):
+        # entries set since the cache was loaded, merged on save with those
+        # saved meanwhile by other runs, unless the cache was cleared
+        self._changes = {}
+        self._cleared = flush
+        if flush:
             self.data = {}
+        elif os.path.isfile(self.cachefilename):
+            self.data = self._read()
+        elif os.path.isfile(self.yaml_cachefilename):
+            logger.info("Migrating cache from '{0}'".format(
+                self.yaml_cachefilename))
+            with io.open(self.yaml_cachefilename, 'r',
+                         encoding='utf-8') as yfile:
+                self.data = yaml.load(yfile, Loader=yaml.Loader) or {}
+            self._changes = dict(self.data)
         else:
-            with io.open(self.cachefilename, 'r', encoding='utf-8') as yfile:
-                self.data = yaml.load(yfile)
+            self.data = {}
         logger.debug("Using cache: '{0}'".format(self.cachefilename))
 
     @staticmethod
@@ -81,10 +236,14 @@ class CacheStorage(object):
         return path
 
     def set(self, job, md5):
-        self.data[job] = md5
+        if self.data.get(job) != md5:
+            self.data[job] = md5
+            self._changes[job] = md5
 
     def clear(self):
         self.data.clear()
+        self._changes.clear()
+        self._cleared = True
 
     def is_cached(self, job):
         if job in self.data:
@@ -96,21 +255,67 @@ class CacheStorage(object):
             return False
         return True
 
+    def _read(self):
+        try:
+            with self._io.open(self.cachefilename, 'rb') as jfile:
+                return self._json.loads(jfile.read().decode('utf-8'))
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        except ValueError as e:
+            self._logger.warning("Ignoring invalid cache file '%s': %s" %
+                                 (self.cachefilename, e))
+        return {}
+
+    def _write(self, data):
+        # write to a temporary file renamed over the cache, so that the
+        # cache is never left half written
+        fd, tmpname = self._tempfile.mkstemp(
+            dir=self._os.path.dirname(self.cachefilename),
+            prefix=self._os.path.basename(self.cachefilename))
+        try:
+            with self._io.open(fd, 'wb') as jfile:
+                jfile.write(self._json.dumps(
+                    data, separators=(',', ':'),
+                    sort_keys=True).encode('utf-8'))
+            if hasattr(self._os, 'replace'):
+                self._os.replace(tmpname, self.cachefilename)
+            else:
+                if self._os.name == 'nt' and \
+                        self._os.path.exists(self.cachefilename):
+                    self._os.remove(self.cachefilename)
+                self._os.rename(tmpname, self.cachefilename)
+        except Exception:
+            self._os.remove(tmpname)
+            raise
+
     def save(self):
         # check we initialized sufficiently in case called via __del__
         # due to an exception occurring in the __init__
-        if getattr(self, 'data', None) is not None:
-            try:
-                with io.open(self.cachefilename, 'w',
-                             encoding='utf-8') as yfile:
-                    self._yaml.dump(self.data, yfile)
-            except Exception as e:
-                self._logger.error("Failed to write to cache file '%s' on "
-                                   "exit: %s" % (self.cachefilename, e))
-            else:
-                self._logger.info("Cache saved")
-                self._logger.debug("Cache written out to '%s'" %
-                                   self.cachefilename)
+        if getattr(self, 'data', None) is None:
+            return
+        if not self._changes and not self._cleared:
+            self._logger.debug("Cache unchanged, not saving")
+            return
+        try:
+            # hold a lock while merging with the entries saved by other
+            # runs, so that none of them are lost
+            with self._io.open(self.cachefilename + '.lock', 'ab') as lock:
+                if self._fcntl is not None:
+                    self._fcntl.flock(lock.fileno(), self._fcntl.LOCK_EX)
+                data = {} if self._cleared else self._read()
+                data.update(self._changes)
+                self._write(data)
+        except Exception as e:
+            self._logger.error("Failed to write to cache file '%s' on "
+                               "exit: %s" % (self.cachefilename, e))
+        else:
+            self.data = data
+            self._changes = {}
+            self._cleared = False
+            self._logger.info("Cache saved")
+            self._logger.debug("Cache written out to '%s'" %
+                               self.cachefilename)
 
     def __del__(self):
         self.save()
@@ -124,46 +329,192 @@ class Jenkins(object):
             self.jenkins = jenkins.Jenkins(url, user, password)
         self._jobs = None
         self._job_list = None
+        self._jobs_lock = threading.Lock()
+        self._crumb_lock = threading.Lock()
+        self._pool_size = None
+        self._instrument_client()
 
-    @property
-    def jobs(self):
+    def _instrument_client(self):
+        # the crumb is fetched by the first request needing it and reused by
+        # all the following ones, so don't let concurrent workers race to
+        # fetch it.
+        maybe_add_crumb = self.jenkins.maybe_add_crumb
+
+        def locked_add_crumb(req):
+            with self._crumb_lock:
+                maybe_add_crumb(req)
+        self.jenkins.maybe_add_crumb = locked_add_crumb
+
+        # older versions of python-jenkins send all requests through
+        # jenkins_open() rather than jenkins_request()
+        if hasattr(jenkins.Jenkins, 'jenkins_request'):
+            name = 'jenkins_request'
+        else:
+            name = 'jenkins_open'
+        send = getattr(self.jenkins, name)
+
+        def timed_send(req, *args, **kwargs):
+            start = time.time()
+            try:
+                return send(req, *args, **kwargs)
+            finally:
+                logger.debug("%s %s took %.3fs",
+                             getattr(req, 'method', None) or req.get_method(),
+                             getattr(req, 'url', None) or req.get_full_url(),
+                             time.time() - start)
+        setattr(self.jenkins, name, timed_send)
+
+    def set_pool_size(self, pool_size):
+        """Keep up to ``pool_size`` connections to Jenkins alive for reuse,
+        so that as many workers can each reuse their own connection rather
+        than opening a new one for every request.
+
+        The connections kept alive so far are only closed when the size
+        changes.
+        """
+        if pool_size == self._pool_size:
+            return
+        session = getattr(self.jenkins, '_session', None)
+        if HTTPAdapter is None or session is None:
+            logger.debug("Connection pooling is not supported by the "
+                         "installed python-jenkins")
+            return
+        logger.debug("Using a pool of %d connections", pool_size)
+        for prefix, adapter in list(session.adapters.items()):
+            if isinstance(adapter, HTTPAdapter):
+                session.mount(prefix, HTTPAdapter(
+                    pool_maxsize=pool_size,
+                    max_retries=adapter.max_retries))
+                adapter.close()
+        self._pool_size = pool_size
+
+    # The jobs are fetched once and then kept up to date with the jobs
+    # created and deleted through this object, until refreshed with
+    # get_jobs(cache=False). All access goes through _jobs_lock so that
+    # the workers share a single snapshot.
+
+    def _load_jobs(self):
         if self._jobs is None:
             # populate jobs
             self._jobs = self.jenkins.get_jobs()
+            self._job_list = set(job['name'] for job in self._jobs)
 
-        return self._jobs
+    @property
+    def jobs(self):
+        with self._jobs_lock:
+            self._load_jobs()
+            return self._jobs
 
     @property
     def job_list(self):
-        if self._job_list is None:
-            self._job_list = set(job['name'] for job in self.jobs)
-        return self._job_list
+        with self._jobs_lock:
+            self._load_jobs()
+            return self._job_list
+
+    def _add_job(self, job_name):
+        with self._jobs_lock:
+            if self._jobs is not None and job_name not in self._job_list:
+                self._jobs = self._jobs + [{'name': job_name}]
+                self._job_list.add(job_name)
+
+    def _remove_job(self, job_name):
+        with self._jobs_lock:
+            if self._jobs is not None and job_name in self._job_list:
+                self._jobs = [job for job in self._jobs
+                              if job['name'] != job_name]
+                self._job_list.discard(job_name)
 
     @parallelize
     def update_job(self, job_name, xml):
         if self.is_job(job_name):
             logger.info("Reconfiguring jenkins job {0}".format(job_name))
             self.jenkins.reconfig_job(job_name, xml)
-        else:
-            logger.info("Creating jenkins job {0}".format(job_name))
+            return
+
+        logger.info("Creating jenkins job {0}".format(job_name))
+        try:
             self.jenkins.create_job(job_name, xml)
+        except jenkins.JenkinsException:
+            # the job may have been created since the jobs were fetched
+            if not self.jenkins.job_exists(job_name):
+                raise
+            logger.info("Reconfiguring jenkins job {0}".format(job_name))
+            self.jenkins.reconfig_job(job_name, xml)
+        self._add_job(job_name)
 
     def is_job(self, job_name):
-        # first use cache
-        if job_name in self.job_list:
-            return True
-
-        # if not exists, use jenkins
-        return self.jenkins.job_exists(job_name)
+        """Return whether the job exists, according to the jobs fetched
+        from Jenkins and the changes made since. Only the top level jobs are
+        fetched, the jobs in folders missing from them are looked up in
+        Jenkins."""
+        with self._jobs_lock:
+            self._load_jobs()
+            if job_name in self._job_list:
+                return True
+        if '/' in job_name:
+            return self.jenkins.job_exists(job_name)
+        return False
 
     def get_job_md5(self, job_name):
         xml = self.jenkins.get_job_config(job_name)
         return hashlib.md5(xml.encode('utf-8')).hexdigest()
 
+    @staticmethod
+    def _batch_entry(job_name, xml):
+        return "['%s', '%s']" % tuple(
+            base64.b64encode(value.encode('utf-8')).decode('ascii')
+            for value in (job_name, xml))
+
+    def update_jobs_by_script(self, jobs):
+        """Create or reconfigure the jobs of ``jobs``, a list of (name, xml)
+        tuples, with a single Groovy script run on the script console.
+
+        Return a list with, in the order of ``jobs``, None for each job
+        updated, or the exception describing why it was not.
+        """
+        output = self.jenkins.run_script(BATCH_UPDATE_SCRIPT % ',\n'.join(
+            self._batch_entry(job_name, xml) for job_name, xml in jobs))
+        statuses = dict((int(n_ord), (status, error)) for n_ord, status, error
+                        in BATCH_STATUS_RE.findall(output))
+
+        results = []
+        for n_ord, (job_name, xml) in enumerate(jobs):
+            status, error = statuses.get(n_ord, (None, None))
+            if status == 'created':
+                logger.info("Created jenkins job {0}".format(job_name))
+                self._add_job(job_name)
+            elif status == 'updated':
+                logger.info("Reconfigured jenkins job {0}".format(job_name))
+            elif status == 'failed':
+                results.append(JenkinsJobsException(
+                    "Failed to update jenkins job {0}: {1}".format(
+                        job_name, base64.b64decode(error).decode('utf-8'))))
+                continue
+            else:
+                results.append(JenkinsJobsException(
+                    "No status reported for jenkins job {0}, the script "
+                    "output was: {1}".format(job_name, output.strip())))
+                continue
+            results.append(None)
+        return results
+
+    def get_job_normalized_md5(self, job_name):
+        """Return the md5 of the configuration of the job on the Jenkins
+        instance, ignoring its formatting, to compare with the normalized md5
+        of a generated job.
+        """
+        return normalized_md5(self.jenkins.get_job_config(job_name))
+
     def delete_job(self, job_name):
-        if self.is_job(job_name):
+        # is_job already looks up the jobs in folders missing from the
+        # snapshot, only the top level jobs created since are looked up here
+        exists = self.is_job(job_name)
+        if not exists and '/' not in job_name:
+            exists = self.jenkins.job_exists(job_name)
+        if exists:
             logger.info("Deleting jenkins job {0}".format(job_name))
             self.jenkins.delete_job(job_name)
+            self._remove_job(job_name)
 
     def delete_all_jobs(self):
         # execute a groovy script to delete all jobs is much faster than
@@ -194,10 +545,20 @@ class Jenkins(object):
 
     def get_jobs(self, cache=True):
         if not cache:
-            self._jobs = None
-            self._job_list = None
+            with self._jobs_lock:
+                self._jobs = None
+                self._job_list = None
         return self.jobs
 
+    def get_job_descriptions(self):
+        """Return a dict of the descriptions of the jobs on the Jenkins
+        instance, keyed by job name, fetched with a single request. Jobs for
+        which no description is reported are left out.
+        """
+        info = self.jenkins.get_info(query=JOBS_DESCRIPTION_QUERY)
+        return dict((job['name'], job['description'])
+                    for job in info.get('jobs', []) if 'description' in job)
+
     def is_managed(self, job_name):
         xml = self.jenkins.get_job_config(job_name)
         try:
@@ -208,6 +569,51 @@ class Jenkins(object):
             pass
         return False
 
+    @parallelize
+    def parallel_is_managed(self, job_name):
+        return self.is_managed(job_name)
+
+    def get_managed_jobs(self, job_names, n_workers=None, pool=None):
+        """Return the set of the jobs in ``job_names`` managed by Jenkins
+        Job Builder.
+
+        The descriptions of all the jobs are fetched in bulk, and only the
+        configuration of the jobs missing from them is fetched, one job at a
+        time but spread over ``n_workers`` workers, or the workers of
+        ``pool`` if given.
+        """
+        try:
+            descriptions = self.get_job_descriptions()
+        except jenkins.JenkinsException as e:
+            logger.warning("Unable to retrieve the job descriptions from {0}, "
+                           "fetching each job configuration instead: {1}"
+                           .format(self.jenkins.server, e))
+            descriptions = {}
+
+        managed = set()
+        remaining = []
+        for job_name in job_names:
+            if job_name not in descriptions:
+                remaining.append(job_name)
+            elif (descriptions[job_name] or '').endswith(MAGIC_MANAGE_STRING):
+                managed.add(job_name)
+
+        if remaining:
+            logger.debug("Fetching the configuration of %d jobs",
+                         len(remaining))
+            results = self.parallel_is_managed(
+                n_workers=n_workers, pool=pool,
+                parallelize=[{'job_name': job_name}
+                             for job_name in remaining])
+            if len(remaining) == 1:
+                results = [results]
+            for job_name, result in zip(remaining, results):
+                if isinstance(result, Exception):
+                    raise result
+                if result:
+                    managed.add(job_name)
+        return managed
+
 
 class Builder(object):
     def __init__(self, jenkins_url, jenkins_user, jenkins_password,
@@ -219,6 +625,7 @@ class Builder(object):
         self.global_config = config
         self.ignore_cache = ignore_cache
         self._plugins_list = plugins_list
+        self._worker_pool = None
 
     @property
     def plugins_list(self):
@@ -226,8 +633,68 @@ class Builder(object):
             self._plugins_list = self.jenkins.get_plugins_info()
         return self._plugins_list
 
-    def load_files(self, fn):
-        self.parser = YamlParser(self.global_config, self.plugins_list)
+    def get_worker_pool(self, n_workers=None):
+        """Return the pool of ``n_workers`` workers, or one per core if not
+        given, shared by the parallel calls of the builder until shutdown()
+        is called. The pool is replaced when a different number of workers
+        is requested.
+        """
+        n_workers = n_workers or multiprocessing.cpu_count()
+        if (self._worker_pool is not None and
+                self._worker_pool.n_workers != n_workers):
+            self._worker_pool.shutdown()
+            self._worker_pool = None
+        if self._worker_pool is None:
+            self._worker_pool = WorkerPool(n_workers)
+        return self._worker_pool
+
+    def shutdown(self):
+        """Stop the workers of the pool shared by the parallel calls."""
+        if self._worker_pool is not None:
+            self._worker_pool.shutdown()
+            self._worker_pool = None
+
+    def get_yaml_cache(self):
+        if (self.global_config and
+                self.global_config.has_section('job_builder') and
+                self.global_config.has_option('job_builder', 'yaml_cache') and
+                self.global_config.getboolean('job_builder', 'yaml_cache')):
+            return YamlCache(os.path.join(CacheStorage.get_cache_dir(),
+                                          'yaml'))
+        return None
+
+    def _get_option(self, option, default, getter='get'):
+        if (self.global_config and
+                self.global_config.has_section('job_builder') and
+                self.global_config.has_option('job_builder', option)):
+            return getattr(self.global_config, getter)('job_builder', option)
+        return default
+
+    def get_upload_engine(self):
+        """Return the name of the engine used to upload the jobs and the
+        maximum number of uploads it keeps in flight, when it limits them
+        itself.
+        """
+        upload_engine = self._get_option('upload_engine', 'threads')
+        concurrency = self._get_option('upload_concurrency', None, 'getint')
+        if upload_engine not in ('threads', 'adaptive', 'script'):
+            raise JenkinsJobsException("Unknown upload engine: '{0}'"
+                                       .format(upload_engine))
+        if upload_engine == 'adaptive' and not concurrency:
+            concurrency = 100
+        return upload_engine, concurrency
+
+    def load_files(self, fn, n_workers=None):
+        """Parse the yaml files found in ``fn`` into a new parser.
+
+        :arg list fn: paths to yaml files or directories, or file-like
+            objects
+        :arg int n_workers: number of worker processes used to parse files,
+            '0' to use one per core. By default, or if '1' is passed, files
+            are parsed one after another in the current process.
+        """
+        self.parser = YamlParser(self.global_config, self.plugins_list,
+                                 yaml_cache=self.get_yaml_cache())
 
         # handle deprecated behavior, and check that it's not a file like
         # object as these may implement the '__iter__' attribute.
@@ -264,27 +731,57 @@ class Builder(object):
                                "reference to avoid duplicating yaml "
                                "definitions." % (f, rpf))
 
-        for in_file in unique_files:
-            # use of ask-for-permissions instead of ask-for-forgiveness
-            # performs better when low use cases.
-            if hasattr(in_file, 'name'):
-                fname = in_file.name
-            else:
-                fname = in_file
-            logger.debug("Parsing YAML file {0}".format(fname))
-            if hasattr(in_file, 'read'):
-                self.parser.parse_fp(in_file)
-            else:
-                self.parser.parse(in_file)
+        # files are loaded by the workers in any order, but are always added
+        # to the parser in the original order so that duplicates are handled
+        # exactly as when parsing serially.
+        pool = None
+        loading = {}
+        if n_workers not in (None, 1) and len(unique_files) > 1:
+            n_workers = n_workers or multiprocessing.cpu_count()
+            logger.debug("Parsing YAML files with %d workers", n_workers)
+            pool = multiprocessing.Pool(n_workers)
+            for in_file in unique_files:
+                if not hasattr(in_file, 'read'):
+                    loading[in_file] = pool.apply_async(
+                        load_yaml_file,
+                        (in_file, self.parser.path, self.parser.yaml_cache))
+            pool.close()
 
-    def delete_old_managed(self, keep=None):
+        try:
+            for in_file in unique_files:
+                # use of ask-for-permissions instead of ask-for-forgiveness
+                # performs better when low use cases.
+                if hasattr(in_file, 'name'):
+                    fname = in_file.name
+                else:
+                    fname = in_file
+                logger.debug("Parsing YAML file {0}".format(fname))
+                if hasattr(in_file, 'read'):
+                    self.parser.parse_fp(in_file)
+                elif in_file in loading:
+                    self.parser.parse_data(loading[in_file].get(), in_file)
+                else:
+                    self.parser.parse(in_file)
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+    def delete_old_managed(self, keep=None, n_workers=None):
         jobs = self.jenkins.get_jobs()
         deleted_jobs = 0
         if keep is None:
-            keep = [job.name for job in self.parser.xml_jobs]
+            # the jobs are not all kept in xml_jobs when their uploads are
+            # pipelined
+            keep = [job['name'] for job in self.parser.jobs]
+        keep = set(keep)
+        self.jenkins.set_pool_size(n_workers or multiprocessing.cpu_count())
+        managed = self.jenkins.get_managed_jobs(
+            [job['name'] for job in jobs if job['name'] not in keep],
+            pool=self.get_worker_pool(n_workers))
         for job in jobs:
             if job['name'] not in keep:
-                if self.jenkins.is_managed(job['name']):
+                if job['name'] in managed:
                     logger.info("Removing obsolete jenkins job {0}"
                                 .format(job['name']))
                     self.delete_job(job['name'])
@@ -327,12 +824,106 @@ class Builder(object):
             logger.debug("'{0}' has not changed".format(job.name))
         return changed
 
+    @parallelize
+    def parallel_get_remote_md5(self, job_name):
+        # return the failures as results, parallelize runs a single job
+        # inline and lets its exception through
+        try:
+            return self.jenkins.get_job_normalized_md5(job_name)
+        except Exception as e:
+            return e
+
+    def filter_remote_changed(self, jobs, n_workers=None):
+        """Return the jobs of ``jobs`` whose configuration differs from the
+        one on the Jenkins instance, recording the others in the cache.
+
+        The configurations of the jobs are fetched in parallel, without
+        checking first whether the jobs exist, and compared ignoring their
+        formatting. The jobs missing from Jenkins, or whose configuration
+        could not be fetched, are considered changed.
+        """
+        logger.debug("Fetching the configuration of %d jobs", len(jobs))
+        results = self._run_parallel(
+            self.parallel_get_remote_md5,
+            [{'job_name': job.name} for job in jobs], n_workers)
+
+        unchanged = set()
+        for job, result in zip(jobs, results):
+            if is_not_found(result):
+                logger.debug("'{0}' is missing from jenkins".format(job.name))
+            elif isinstance(result, Exception):
+                logger.warning("Unable to compare jenkins job {0} with its "
+                               "configuration on {1}: {2}".format(
+                                   job.name, self.jenkins.jenkins.server,
+                                   result))
+            elif result == job.normalized_md5():
+                logger.debug("'{0}' is up to date in jenkins"
+                             .format(job.name))
+                self.cache.set(job.name, job.md5())
+                unchanged.add(job.name)
+        logger.info("Number of jobs already up to date in jenkins: %d",
+                    len(unchanged))
+        return [job for job in jobs if job.name not in unchanged]
+
+    def _run_parallel(self, func, p_params, n_workers=None, stream=False,
+                      fail_fast=None):
+        """Run the parallelized method ``func`` with each of ``p_params``
+        on the upload engine, and return the list of their results.
+
+        With the threads upload engine, ``stream`` and ``fail_fast`` are
+        passed on to parallelize, the other engines return all the results
+        at once and never cancel any run.
+        """
+        upload_engine, concurrency = self.get_upload_engine()
+        # the script engine runs its batches from the worker threads
+        if upload_engine == 'adaptive':
+            self.jenkins.set_pool_size(concurrency)
+            return run_adaptive(
+                func, p_params, concurrency,
+                self._get_option('upload_latency_target', 2.0, 'getfloat'),
+                self._get_option('upload_max_rps', None, 'getfloat'),
+                is_overload=is_overload,
+                retries=self._get_option('upload_retries', 3, 'getint'),
+                retry_delay=self._get_option('upload_retry_delay', 1.0,
+                                             'getfloat'),
+                is_transient=is_transient)
+        self.jenkins.set_pool_size(n_workers or multiprocessing.cpu_count())
+        return self._parallelize(func, p_params, n_workers, stream, fail_fast)
+
+    def _parallelize(self, func, p_params, n_workers=None, stream=False,
+                     fail_fast=None):
+        """Run the parallelized method ``func`` with each of ``p_params`` on
+        the shared worker pool, and return the list of their results, or a
+        generator yielding them if ``stream`` is set.
+        """
+        results = func(parallelize=p_params,
+                       pool=self.get_worker_pool(n_workers),
+                       stream=stream, fail_fast=fail_fast)
+        # generalize the result parsing, as a parallelized job always
+        # returns a list
+        if not stream and len(p_params) in (1, 0):
+            results = [results]
+        return results
+
     def update_jobs(self, input_fn, jobs_glob=None, output=None,
                     n_workers=None):
+        """Generate the jobs defined in the yaml files found in ``input_fn``
+        and upload those that changed, or write all of them into ``output``.
+
+        Return a list of the jobs uploaded, or written, with their number.
+        The list holds the XmlJob objects of the jobs, except with the
+        ``upload_pipeline`` option, or ``stream_output`` when writing them,
+        which keep no job once uploaded or written: the list then holds the
+        names of the jobs, sorted.
+        """
         orig = time.time()
-        self.load_files(input_fn)
+        self.load_files(input_fn, n_workers=n_workers)
         self.parser.expandYaml(jobs_glob)
-        self.parser.generateXML()
+        if not output and self._pipeline_uploads():
+            return self._update_jobs_pipelined(n_workers, orig)
+        if output and self._get_option('stream_output', False, 'getboolean'):
+            return self._write_jobs_streamed(output, n_workers)
+        self.parser.generateXML(n_workers=n_workers)
         step = time.time()
         logging.debug('%d XML files generated in %ss',
                       len(self.parser.jobs), str(step - orig))
@@ -340,86 +931,286 @@ class Builder(object):
         logger.info("Number of jobs generated:  %d", len(self.parser.xml_jobs))
         self.parser.xml_jobs.sort(key=operator.attrgetter('name'))
 
-        if (output and not hasattr(output, 'write')
-                and not os.path.isdir(output)):
-            logger.info("Creating directory %s" % output)
-            try:
-                os.makedirs(output)
-            except OSError:
-                if not os.path.isdir(output):
-                    raise
-
         if output:
-            # ensure only wrapped once
-            if hasattr(output, 'write'):
-                output = utils.wrap_stream(output)
-
-            for job in self.parser.xml_jobs:
-                if hasattr(output, 'write'):
-                    # `output` is a file-like object
-                    logger.info("Job name:  %s", job.name)
-                    logger.debug("Writing XML to '{0}'".format(output))
-                    try:
-                        output.write(job.output())
-                    except IOError as exc:
-                        if exc.errno == errno.EPIPE:
-                            # EPIPE could happen if piping output to something
-                            # that doesn't read the whole input (e.g.: the UNIX
-                            # `head` command)
-                            return
-                        raise
-                    continue
-
-                output_fn = os.path.join(output, job.name)
-                logger.debug("Writing XML to '{0}'".format(output_fn))
-                with io.open(output_fn, 'w', encoding='utf-8') as f:
-                    f.write(job.output().decode('utf-8'))
+            if not self._write_jobs(output, self.parser.xml_jobs):
+                return
             return self.parser.xml_jobs, len(self.parser.xml_jobs)
 
         # Filter out the jobs that did not change
         logging.debug('Filtering %d jobs for changed jobs',
                       len(self.parser.xml_jobs))
         step = time.time()
-        jobs = [job for job in self.parser.xml_jobs
-                if self.changed(job)]
+        changed = self._parallelize(
+            self.changed, [{'job': job} for job in self.parser.xml_jobs],
+            n_workers)
+        jobs = []
+        for job, result in zip(self.parser.xml_jobs, changed):
+            if isinstance(result, Exception):
+                raise result
+            if result:
+                jobs.append(job)
         logging.debug("Filtered for changed jobs in %ss",
                       (time.time() - step))
 
         if not jobs:
             return [], 0
 
+        # take a snapshot of the existing jobs for the workers to share
+        self.jenkins.get_jobs(cache=False)
+
+        if self._get_option('remote_diff', False, 'getboolean'):
+            step = time.time()
+            jobs = self.filter_remote_changed(jobs, n_workers=n_workers)
+            logging.debug("Compared with the jobs in jenkins in %ss",
+                          time.time() - step)
+            if not jobs:
+                self.cache.save()
+                return [], 0
+
         # Update the jobs
         logging.debug('Updating jobs')
         step = time.time()
-        p_params = [{'job': job} for job in jobs]
-        results = self.parallel_update_job(
-            n_workers=n_workers,
-            parallelize=p_params)
+        if self.get_upload_engine()[0] == 'script':
+            results = self.update_jobs_by_script(jobs, n_workers=n_workers)
+        else:
+            results = self._run_parallel(self.parallel_update_job,
+                                         [{'job': job} for job in jobs],
+                                         n_workers, stream=True,
+                                         fail_fast=self._get_fail_fast())
         logging.debug("Parsing results")
-        # generalize the result parsing, as a parallelized job always returns a
-        # list
-        if len(p_params) in (1, 0):
-            results = [results]
-        for result in results:
-            if isinstance(result, Exception):
-                raise result
-            else:
-                # update in-memory cache
-                j_name, j_md5 = result
-                self.cache.set(j_name, j_md5)
-        # write cache to disk
-        self.cache.save()
+        self._record_results(results)
         logging.debug("Updated %d jobs in %ss",
                       len(jobs),
                       time.time() - step)
         logging.debug("Total run took %ss", (time.time() - orig))
         return jobs, len(jobs)
 
+    def _write_jobs(self, output, jobs):
+        """Write the XML of the jobs from the iterable ``jobs`` into the
+        directory or file-like object ``output``.
+
+        Return False if the output was closed before all of them were
+        written.
+        """
+        if (not hasattr(output, 'write')
+                and not os.path.isdir(output)):
+            logger.info("Creating directory %s" % output)
+            try:
+                os.makedirs(output)
+            except OSError:
+                if not os.path.isdir(output):
+                    raise
+
+        # ensure only wrapped once
+        if hasattr(output, 'write'):
+            output = utils.wrap_stream(output)
+
+        for job in jobs:
+            if hasattr(output, 'write'):
+                # `output` is a file-like object
+                logger.info("Job name:  %s", job.name)
+                logger.debug("Writing XML to '{0}'".format(output))
+                try:
+                    output.write(job.output())
+                except IOError as exc:
+                    if exc.errno == errno.EPIPE:
+                        # EPIPE could happen if piping output to something
+                        # that doesn't read the whole input (e.g.: the UNIX
+                        # `head` command)
+                        return False
+                    raise
+                continue
+
+            output_fn = os.path.join(output, job.name)
+            logger.debug("Writing XML to '{0}'".format(output_fn))
+            with io.open(output_fn, 'w', encoding='utf-8') as f:
+                f.write(job.output().decode('utf-8'))
+        return True
+
+    def _write_jobs_streamed(self, output, n_workers):
+        """Write the XML of each job as soon as it is generated, in the
+        same order as update_jobs() does, without keeping it once written.
+
+        The job definitions are sorted by name beforehand instead of the
+        generated jobs, xml_jobs is left empty and the names of the jobs
+        written are returned in place of the jobs.
+        """
+        self.parser.jobs.sort(key=operator.itemgetter('name'))
+        names = []
+
+        def generated():
+            for job in self.parser.iterXML(n_workers):
+                names.append(job.name)
+                yield job
+
+        written = self._write_jobs(output, generated())
+        logger.info("Number of jobs generated:  %d", len(names))
+        if not written:
+            return
+        return names, len(names)
+
+    def _get_fail_fast(self):
+        # stop on the first failure if asked to, and in any case when the
+        # others would fail the same way
+        if self._get_option('upload_fail_fast', False, 'getboolean'):
+            return True
+        return is_fatal
+
+    def _record_results(self, results):
+        """Record the jobs updated in the cache as the ``results`` of their
+        uploads come in, a (name, md5) tuple for each of them or None for a
+        job left unchanged, and return their names.
+
+        The failures are raised once all the results are in, and the cache
+        is saved in any case.
+        """
+        names = []
+        failures = []
+        cancelled = 0
+        try:
+            for result in results:
+                if isinstance(result, TaskCancelled):
+                    cancelled += 1
+                elif isinstance(result, Exception):
+                    failures.append(result)
+                elif result is not None:
+                    # update in-memory cache as the results come in
+                    j_name, j_md5 = result
+                    self.cache.set(j_name, j_md5)
+                    names.append(j_name)
+        finally:
+            # write cache to disk, even when some jobs failed or the update
+            # was interrupted so that they are the only ones updated again
+            # on the next run
+            self.cache.save()
+        if failures:
+            logger.error("Failed to update %d of %d jobs", len(failures),
+                         len(names) + len(failures) + cancelled)
+            if cancelled:
+                logger.error("Cancelled the update of %d jobs after the "
+                             "failure of the first ones", cancelled)
+            raise failures[0]
+        return names
+
+    def _pipeline_uploads(self):
+        if not self._get_option('upload_pipeline', False, 'getboolean'):
+            return False
+        if (self.get_upload_engine()[0] != 'threads' or
+                self._get_option('remote_diff', False, 'getboolean')):
+            logger.warning("Not pipelining the uploads, only supported with "
+                           "the threads upload engine and without "
+                           "remote_diff")
+            return False
+        return True
+
+    def _pipeline_update_job(self, job):
+        if not self.changed(job):
+            return None
+        return self.parallel_update_job(job)
+
+    def _update_jobs_pipelined(self, n_workers, orig):
+        """Update the jobs as their XML is generated, with a bounded number
+        of them generated ahead of the uploads, instead of generating all of
+        them first. No job is kept once uploaded, the names of the jobs
+        updated are returned sorted in place of the jobs.
+        """
+        # take a snapshot of the existing jobs for the workers to share
+        self.jenkins.get_jobs(cache=False)
+        pool = self.get_worker_pool(n_workers)
+        self.jenkins.set_pool_size(pool.n_workers)
+        depth = self._get_option('upload_queue_depth', 2 * pool.n_workers,
+                                 'getint')
+        logger.info("Number of jobs generated:  %d", len(self.parser.jobs))
+        logging.debug('Updating jobs as they are generated, with up to %d '
+                      'of them queued', depth)
+        # start the processes generating the XML, if any, from this thread
+        # rather than from the one feeding the uploads, and have them
+        # generate no more jobs ahead than queued for the uploads
+        xml_jobs = self.parser.iterXML(n_workers, max_ahead=depth)
+        results = pool.pipeline(
+            self._pipeline_update_job,
+            ({'job': job} for job in xml_jobs),
+            depth, fail_fast=self._get_fail_fast())
+
+        names = sorted(self._record_results(results))
+        logging.debug("Total run took %ss", (time.time() - orig))
+        return names, len(names)
+
+    def _retry_upload(self, what, func, *args):
+        """Return the result of ``func(*args)``, called again after the
+        transient failures of the upload of ``what``.
+        """
+        # the adaptive engine retries the uploads itself, so that it slows
+        # down on each failure and doesn't count the backoff as a run
+        if self.get_upload_engine()[0] == 'adaptive':
+            return func(*args)
+        retries = self._get_option('upload_retries', 3, 'getint')
+        delay = self._get_option('upload_retry_delay', 1.0, 'getfloat')
+        attempt = 0
+        while True:
+            try:
+                return func(*args)
+            except Exception as e:
+                if attempt >= retries or not is_transient(e):
+                    raise
+                # exponential backoff, with jitter so that the workers
+                # failing together don't all retry at the same time
+                backoff = delay * 2 ** attempt * random.uniform(0.5, 1.5)
+                attempt += 1
+                logger.warning("Failed to update {0}: {1}, "
+                               "retrying in {2:.1f}s ({3}/{4})".format(
+                                   what, e, backoff, attempt, retries))
+                time.sleep(backoff)
+
     @parallelize
     def parallel_update_job(self, job):
-        self.jenkins.update_job(job.name, job.output().decode('utf-8'))
+        self._retry_upload('jenkins job {0}'.format(job.name),
+                           self.jenkins.update_job,
+                           job.name, job.output().decode('utf-8'))
         return (job.name, job.md5())
 
+    @parallelize
+    def parallel_update_job_batch(self, jobs):
+        # creating or reconfiguring a job again is harmless, so the whole
+        # batch is sent again after a transient failure
+        results = self._retry_upload(
+            'batch of {0} jenkins jobs'.format(len(jobs)),
+            self.jenkins.update_jobs_by_script,
+            [(job.name, job.output().decode('utf-8')) for job in jobs])
+        return [result or (job.name, job.md5())
+                for job, result in zip(jobs, results)]
+
+    def update_jobs_by_script(self, jobs, n_workers=None):
+        """Upload ``jobs`` in batches run on the script console, each of them
+        holding as many jobs as fit in ``upload_batch_size`` bytes of
+        script, and return the (name, md5) tuple of each job uploaded or the
+        exception raised for it, in the order of ``jobs``.
+        """
+        batch_size = self._get_option('upload_batch_size', 100000, 'getint')
+        batches = [[]]
+        size = 0
+        for job in jobs:
+            job_size = len(Jenkins._batch_entry(
+                job.name, job.output().decode('utf-8')))
+            if batches[-1] and size + job_size > batch_size:
+                batches.append([])
+                size = 0
+            batches[-1].append(job)
+            size += job_size
+        logger.debug("Uploading %d jobs in %d batches",
+                     len(jobs), len(batches))
+
+        results = self._run_parallel(self.parallel_update_job_batch,
+                                     [{'jobs': batch} for batch in batches],
+                                     n_workers)
+        job_results = []
+        for batch, result in zip(batches, results):
+            if isinstance(result, Exception):
+                job_results.extend([result] * len(batch))
+            else:
+                job_results.extend(result)
+        return job_results
+
     def update_job(self, input_fn, jobs_glob=None, output=None):
         logging.warn('Current update_job function signature is deprecated and '
                      'will change in future versions to the signature of the '
@@ -42,6 +42,7 @@ recursive=False
 exclude=.*
 allow_duplicates=False
 allow_empty_variables=False
+yaml_cache=False
 
 [jenkins]
 url=http://localhost:8080/
@@ -114,6 +115,34 @@ def create_parser():
     parser_update.add_argument('--workers', dest='n_workers', type=int,
                                default=1, help='number of workers to use, 0 '
                                'for autodetection and 1 for just one worker.')
+    parser_update.add_argument('--upload-engine', dest='upload_engine',
+                               choices=['threads', 'adaptive', 'script'],
+                               default=None,
+                               help='upload jobs from the worker threads '
+                               '(default), with a concurrency adapted to '
+                               'the latency, '
+                               'or in batches run on the script console.')
+    parser_update.add_argument('--concurrency', dest='upload_concurrency',
+                               type=int, default=None,
+                               help='maximum number of uploads in flight '
+                               'with the adaptive upload engine.')
+    parser_update.add_argument('--max-rps', dest='upload_max_rps',
+                               type=float, default=None,
+                               help='maximum number of uploads started per '
+                               'second with the adaptive upload engine.')
+    parser_update.add_argument('--remote-diff', dest='remote_diff',
+                               action='store_true', default=False,
+                               help='compare the changed jobs with their '
+                               'configuration in Jenkins and only upload '
+                               'the ones that differ.')
+    parser_update.add_argument('--fail-fast', dest='upload_fail_fast',
+                               action='store_true', default=False,
+                               help='stop uploading the jobs after the first '
+                               'failure.')
+    parser_update.add_argument('--pipeline', dest='upload_pipeline',
+                               action='store_true', default=False,
+                               help='upload the jobs as they are generated '
+                               'instead of generating all of them first.')
 
     # subparser: test
     parser_test = subparser.add_parser('test', parents=[recursive_parser])
@@ -124,6 +153,11 @@ def create_parser():
                              help='path to plugin info YAML file')
     parser_test.add_argument('-o', dest='output_dir', default=sys.stdout,
                              help='path to output XML')
+    parser_test.add_argument('--stream', dest='stream_output',
+                             action='store_true', default=False,
+                             help='write the XML of each job as soon as it '
+                             'is generated instead of generating all of them '
+                             'first, to keep the memory used flat.')
     parser_test.add_argument('name', help='name(s) of job(s)', nargs='*')
 
     # subparser: delete
@@ -364,17 +398,44 @@ def execute(options, config):
         if options.n_workers < 0:
             raise JenkinsJobsException(
                 'Number of workers must be equal or greater than 0')
+        if options.upload_engine is not None:
+            config.set('job_builder', 'upload_engine', options.upload_engine)
+        if options.upload_concurrency is not None:
+            if options.upload_concurrency < 1:
+                raise JenkinsJobsException(
+                    'Concurrency must be equal or greater than 1')
+            config.set('job_builder', 'upload_concurrency',
+                       str(options.upload_concurrency))
+        if options.upload_max_rps is not None:
+            if options.upload_max_rps <= 0:
+                raise JenkinsJobsException(
+                    'Maximum requests per second must be greater than 0')
+            config.set('job_builder', 'upload_max_rps',
+                       str(options.upload_max_rps))
+        if options.remote_diff:
+            config.set('job_builder', 'remote_diff', 'True')
+        if options.upload_fail_fast:
+            config.set('job_builder', 'upload_fail_fast', 'True')
+        if options.upload_pipeline:
+            config.set('job_builder', 'upload_pipeline', 'True')
 
         logger.info("Updating jobs in {0} ({1})".format(
             options.path, options.names))
-        jobs, num_updated_jobs = builder.update_jobs(
-            options.path, options.names,
-            n_workers=options.n_workers)
-        logger.info("Number of jobs updated: %d", num_updated_jobs)
-        if options.delete_old:
-            num_deleted_jobs = builder.delete_old_managed()
-            logger.info("Number of jobs deleted: %d", num_deleted_jobs)
+        try:
+            jobs, num_updated_jobs = builder.update_jobs(
+                options.path, options.names,
+                n_workers=options.n_workers)
+            logger.info("Number of jobs updated: %d", num_updated_jobs)
+            if options.delete_old:
+                num_deleted_jobs = builder.delete_old_managed(
+                    n_workers=options.n_workers)
+                logger.info("Number of jobs deleted: %d", num_deleted_jobs)
+        finally:
+            # stop the workers shared by the update and the deletion
+            builder.shutdown()
     elif options.command == 'test':
+        if options.stream_output:
+            config.set('job_builder', 'stream_output', 'True')
         builder.update_jobs(options.path, options.name,
                             output=options.output_dir,
                             n_workers=1)
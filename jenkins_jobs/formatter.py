@@ -15,15 +15,23 @@
 
 # Manage interpolation of JJB variables into template strings.
 
+from collections import OrderedDict
 import logging
 from pprint import pformat
 import re
 from string import Formatter
+import threading
 
 from jenkins_jobs.errors import JenkinsJobsException
 
 logger = logging.getLogger(__name__)
 
+OBJ_FIELD_RE = re.compile(r'^{obj:(?P<key>\w+)}$')
+SIMPLE_FIELD_RE = re.compile(r'^(?!\d+$)[^.\[]+$')
+
+# maximum number of distinct format strings kept compiled
+TEMPLATE_CACHE_SIZE = 4096
+
 
 def deep_format(obj, paramdict, allow_empty=False):
     """Apply the paramdict via str.format() to all string objects found within
@@ -34,13 +42,13 @@ def deep_format(obj, paramdict, allow_empty=False):
     # example, is problematic).
     if hasattr(obj, 'format'):
         try:
-            result = re.match('^{obj:(?P<key>\w+)}$', obj)
+            result = OBJ_FIELD_RE.match(obj)
             if result is not None:
                 ret = paramdict[result.group("key")]
             else:
-                ret = CustomFormatter(allow_empty).format(obj, **paramdict)
+                ret = format_string(obj, paramdict, allow_empty)
         except KeyError as exc:
-            missing_key = exc.message
+            missing_key = exc.args[0]
             desc = "%s parameter missing to format %s\nGiven:\n%s" % (
                 missing_key, obj, pformat(paramdict))
             raise JenkinsJobsException(desc)
@@ -52,10 +60,10 @@ def deep_format(obj, paramdict, allow_empty=False):
         ret = type(obj)()
         for item in obj:
             try:
-                ret[CustomFormatter(allow_empty).format(item, **paramdict)] = \
+                ret[format_string(item, paramdict, allow_empty)] = \
                     deep_format(obj[item], paramdict, allow_empty)
             except KeyError as exc:
-                missing_key = exc.message
+                missing_key = exc.args[0]
                 desc = "%s parameter missing to format %s\nGiven:\n%s" % (
                     missing_key, obj, pformat(paramdict))
                 raise JenkinsJobsException(desc)
@@ -64,6 +72,112 @@ def deep_format(obj, paramdict, allow_empty=False):
     return ret
 
 
+def format_string(fmt, paramdict, allow_empty=False):
+    """Equivalent of ``CustomFormatter(allow_empty).format(fmt, **paramdict)``
+    using a compiled and cached copy of the format string.
+    """
+    if '{' not in fmt and '}' not in fmt:
+        return fmt
+    return CompiledTemplate.get(fmt).format(paramdict, allow_empty)
+
+
+class LazyFormatDict(dict):
+    """
+    Dict of parameters whose values are formatted against the original
+    parameters the first time each of them is looked up, giving the same
+    values as ``deep_format(params, params)`` for the parameters that are
+    actually used, without formatting all the others.
+
+    Values set after creation are stored as given. Only item lookups format
+    values, methods such as get() or items() return them unformatted.
+    """
+
+    def __init__(self, params):
+        super(LazyFormatDict, self).__init__(params)
+        self._params = params
+        self._formatted = set()
+
+    def __getitem__(self, key):
+        value = super(LazyFormatDict, self).__getitem__(key)
+        if key not in self._formatted:
+            value = deep_format(value, self._params)
+            self[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self._formatted.add(key)
+        super(LazyFormatDict, self).__setitem__(key, value)
+
+
+class CompiledTemplate(object):
+    """
+    Format string parsed once into its literal text and replacement fields,
+    so that it can be rendered repeatedly against a dict of parameters.
+
+    Fields naming a single parameter without any conversion or format spec
+    are looked up directly, any other field is rendered through
+    CustomFormatter to keep the semantics of str.format().
+    """
+    _cache = OrderedDict()
+    _cache_lock = threading.Lock()
+
+    def __init__(self, fmt):
+        self.segments = []
+        for literal, field_name, spec, conversion in Formatter().parse(fmt):
+            if field_name is None:
+                self.segments.append((literal, None, None))
+            elif (not spec and conversion is None and
+                    SIMPLE_FIELD_RE.match(field_name)):
+                self.segments.append((literal, field_name, None))
+            else:
+                field = '{' + field_name
+                if conversion is not None:
+                    field += '!' + conversion
+                if spec:
+                    field += ':' + spec
+                self.segments.append((literal, None, field + '}'))
+
+    @classmethod
+    def get(cls, fmt):
+        """Return the compiled template for ``fmt``, keeping the most recently
+        used ones cached.
+        """
+        with cls._cache_lock:
+            template = cls._cache.pop(fmt, None)
+            if template is not None:
+                cls._cache[fmt] = template
+                return template
+
+        template = cls(fmt)
+        with cls._cache_lock:
+            cls._cache[fmt] = template
+            if len(cls._cache) > TEMPLATE_CACHE_SIZE:
+                cls._cache.popitem(last=False)
+        return template
+
+    def format(self, paramdict, allow_empty=False):
+        result = []
+        for literal, key, field in self.segments:
+            if literal:
+                result.append(literal)
+            if key is not None:
+                try:
+                    value = paramdict[key]
+                except KeyError:
+                    if not allow_empty:
+                        raise
+                    logger.debug(
+                        'Found uninitialized key %s, replaced with empty '
+                        'string', key
+                    )
+                    value = ''
+                result.append(format(value, ''))
+            elif field is not None:
+                result.append(
+                    CustomFormatter(allow_empty).vformat(field, (), paramdict))
+        return ''.join(result)
+
+
 class CustomFormatter(Formatter):
     """
     Custom formatter to allow non-existing key references when formatting a
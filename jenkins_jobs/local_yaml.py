@@ -92,7 +92,9 @@ character.
 
 """
 
+import errno
 import functools
+import hashlib
 import io
 import logging
 import os
@@ -103,6 +105,12 @@ from yaml.constructor import BaseConstructor
 from yaml import YAMLObject
 
 from collections import OrderedDict
+from six.moves import cPickle as pickle
+
+try:
+    from yaml.cyaml import CParser
+except ImportError:
+    CParser = None
 
 
 logger = logging.getLogger(__name__)
@@ -214,6 +222,14 @@ class LocalLoader(OrderedConstructor, LocalAnchorLoader):
         else:
             self.escape_callback = self._escape
 
+        # list shared with the loaders of any included yaml files to record
+        # the absolute path of every file included while loading, preceded
+        # by the paths tried before finding it in the search path
+        if 'included_files' in kwargs:
+            self.included_files = kwargs.pop('included_files')
+        else:
+            self.included_files = list()
+
         super(LocalLoader, self).__init__(*args, **kwargs)
 
         # constructor to preserve order of maps and ensure that the order of
@@ -230,6 +246,43 @@ class LocalLoader(OrderedConstructor, LocalAnchorLoader):
         return re.sub(r'({|})', r'\1\1', data)
 
 
+class LocalCLoader(LocalLoader):
+    """Variant of LocalLoader which uses libyaml to scan and parse the
+    stream, which is considerably faster than the pure python implementation.
+
+    Only the events are taken from the libyaml parser, the nodes are still
+    composed and constructed in python so that anchors are kept between calls
+    and all of the custom tags remain available.
+
+    Only available when PyYAML has been built with libyaml support, use
+    ``local_yaml.load`` to have the fastest available loader picked
+    automatically.
+    """
+
+    def __init__(self, stream, *args, **kwargs):
+        self._cparser = CParser(stream)
+        # the python reader is never used, so only give it an empty document
+        super(LocalCLoader, self).__init__(u'', *args, **kwargs)
+
+        if hasattr(stream, 'name'):
+            # keep the directory of the file ahead of the current directory
+            self.search_path.insert(-1, os.path.normpath(
+                os.path.dirname(stream.name)))
+
+    def check_event(self, *choices):
+        return self._cparser.check_event(*choices)
+
+    def peek_event(self):
+        return self._cparser.peek_event()
+
+    def get_event(self):
+        return self._cparser.get_event()
+
+    def dispose(self):
+        super(LocalCLoader, self).dispose()
+        self._cparser.dispose()
+
+
 class BaseYAMLObject(YAMLObject):
     yaml_loader = LocalLoader
     yaml_dumper = yaml.Dumper
@@ -239,19 +292,24 @@ class YamlInclude(BaseYAMLObject):
     yaml_tag = u'!include:'
 
     @classmethod
-    def _find_file(cls, filename, search_path):
+    def _find_file(cls, filename, search_path, missed=None):
         for dirname in search_path:
             candidate = os.path.expanduser(os.path.join(dirname, filename))
             if os.path.isfile(candidate):
                 logger.info("Including file '{0}' from path '{1}'"
                             .format(filename, dirname))
                 return candidate
+            if missed is not None:
+                missed.append(candidate)
         return filename
 
     @classmethod
     def _open_file(cls, loader, scalar_node):
+        missed = []
         filename = cls._find_file(loader.construct_yaml_str(scalar_node),
-                                  loader.search_path)
+                                  loader.search_path, missed)
+        loader.included_files.extend(
+            os.path.abspath(fn) for fn in missed + [filename])
         try:
             with io.open(filename, 'r', encoding='utf-8') as f:
                 return f.read()
@@ -262,9 +320,12 @@ class YamlInclude(BaseYAMLObject):
 
     @classmethod
     def _from_file(cls, loader, node):
+        # use the same loader class as the including file
         data = yaml.load(cls._open_file(loader, node),
-                         functools.partial(cls.yaml_loader,
-                                           search_path=loader.search_path))
+                         functools.partial(
+                             type(loader),
+                             search_path=loader.search_path,
+                             included_files=loader.included_files))
         return data
 
     @classmethod
@@ -322,4 +383,105 @@ class YamlIncludeRawEscapeDeprecated(DeprecatedTag):
 
 def load(stream, **kwargs):
     LocalAnchorLoader.reset_anchors()
-    return yaml.load(stream, functools.partial(LocalLoader, **kwargs))
+    if CParser is not None:
+        loader = LocalCLoader
+    else:
+        loader = LocalLoader
+    return yaml.load(stream, functools.partial(loader, **kwargs))
+
+
+class YamlCache(object):
+    """Persistent cache of the data loaded from yaml files.
+
+    Each file loaded gets an entry under ``cache_dir`` holding the pickled
+    data along with the digest of the file and of every file it included
+    while being loaded, and the paths searched before finding those. The
+    cached data is only used when none of those digests have changed and
+    none of the paths searched exist, otherwise the file is loaded again
+    and the entry replaced.
+
+    The entries are kept by file, search path and current directory, which
+    is searched last.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                if not os.path.isdir(cache_dir):
+                    raise
+
+    @staticmethod
+    def _digest(content):
+        return hashlib.sha1(content).hexdigest()
+
+    def _get_included_digests(self, included_files):
+        # the paths searched before finding a file get no digest, so that
+        # a file created there changes them
+        digests = []
+        for fn in included_files:
+            try:
+                with io.open(fn, 'rb') as f:
+                    digests.append((fn, self._digest(f.read())))
+            except IOError as e:
+                if e.errno not in (errno.ENOENT, errno.EISDIR,
+                                   errno.ENOTDIR):
+                    raise
+                digests.append((fn, None))
+        return digests
+
+    def _read_entry(self, entry_fn, digest):
+        try:
+            with io.open(entry_fn, 'rb') as f:
+                entry_digest, includes, data = pickle.load(f)
+            if entry_digest != digest:
+                return None
+            if self._get_included_digests(
+                    [fn for fn, _ in includes]) != includes:
+                return None
+        except Exception as e:
+            logger.debug("Ignoring cache entry '{0}': {1}"
+                         .format(entry_fn, e))
+            return None
+        return data
+
+    def _write_entry(self, entry_fn, digest, includes, data):
+        tmp_fn = '{0}.{1}'.format(entry_fn, os.getpid())
+        try:
+            with io.open(tmp_fn, 'wb') as f:
+                pickle.dump((digest, includes, data), f,
+                            pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_fn, entry_fn)
+        except Exception as e:
+            logger.warning("Failed to write cache entry '{0}': {1}"
+                           .format(entry_fn, e))
+
+    def load(self, fn, search_path=None):
+        """Return the data loaded from the yaml file ``fn``, using the cached
+        copy if neither the file nor any of its includes have changed.
+        """
+        search_path = search_path or []
+        fn = os.path.realpath(fn)
+        # one entry per file, which is replaced whenever the file changes
+        entry_fn = os.path.join(self.cache_dir, self._digest(u'\0'.join(
+            [fn, os.getcwd()] + [os.path.abspath(os.path.expanduser(path))
+                                 for path in search_path]
+        ).encode('utf-8')) + '.pickle')
+
+        with io.open(fn, 'rb') as fp:
+            digest = self._digest(fp.read())
+            data = self._read_entry(entry_fn, digest)
+            if data is not None:
+                logger.debug("Using cached data for '{0}'".format(fn))
+                return data
+
+            fp.seek(0)
+            included_files = []
+            data = load(fp, search_path=search_path,
+                        included_files=included_files)
+
+        includes = self._get_included_digests(included_files)
+        self._write_entry(entry_fn, digest, includes, data)
+        return data
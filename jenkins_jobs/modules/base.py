@@ -54,6 +54,20 @@ class Base(object):
     #: doesn't have components.
     component_list_type = None
 
+    #: The top-level sections of the YAML data (such as ``job``) read by
+    #: handle_data().  When set, handle_data() is only called again once
+    #: entries of these sections have changed, and only needs to visit the
+    #: entries returned by :py:meth:`YamlParser.changed_data`.  Leave it
+    #: set to None to have handle_data() called on every pass.
+    data_reads = None
+
+    #: The top-level sections of the YAML data modified by handle_data().
+    #: Changes to individual entries can also be reported with
+    #: :py:meth:`YamlParser.mark_data_changed`, otherwise all the entries
+    #: of these sections, or of every section when None, are considered
+    #: changed whenever handle_data() returns ``True``.
+    data_writes = None
+
     def __init__(self, registry):
         self.registry = registry
 
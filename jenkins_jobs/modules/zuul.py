@@ -20,8 +20,6 @@ have. It is entirely optional, Zuul 2.0+ pass the parameters over Gearman.
 http://docs.openstack.org/infra/zuul/launchers.html#zuul-parameters
 """
 
-import itertools
-
 
 def zuul():
     """yaml: zuul
@@ -134,12 +132,15 @@ ZUUL_POST_PARAMETERS = [
 
 class Zuul(jenkins_jobs.modules.base.Base):
     sequence = 0
+    data_reads = ('job', 'job-template')
+    data_writes = ('job', 'job-template')
 
     def handle_data(self, parser):
         changed = False
-        jobs = itertools.chain(parser.data.get('job', {}).values(),
-                               parser.data.get('job-template', {}).values())
-        for job in jobs:
+        jobs = ((section, name, job)
+                for section in self.data_reads
+                for name, job in parser.changed_data(section).items())
+        for section, name, job in jobs:
             triggers = job.get('triggers')
             if not triggers:
                 continue
@@ -155,5 +156,6 @@ class Zuul(jenkins_jobs.modules.base.Base):
             if 'zuul-post' in job.get('triggers', []):
                 job['parameters'].extend(ZUUL_POST_PARAMETERS)
                 job['triggers'].remove('zuul-post')
+            parser.mark_data_changed(section, name)
             changed = True
         return changed
@@ -17,8 +17,11 @@
 
 from functools import wraps
 import logging
+import math
 from multiprocessing import cpu_count
+import random
 import threading
+import time
 import traceback
 
 try:
@@ -29,21 +32,36 @@ except ImportError:
 logger = logging.getLogger(__name__)
 
 
+class TaskCancelled(Exception):
+    """
+    Returned in place of the result of the tasks that were cancelled before
+    they started, after another task failed.
+    """
+
+
 class TaskFunc(dict):
     """
     Simple class to wrap around the information needed to run a function.
     """
-    def __init__(self, n_ord, func, args=None, kwargs=None):
+    def __init__(self, n_ord, func, args=None, kwargs=None, out_queue=None,
+                 cancel=None, fail_fast=None):
         self['func'] = func
         self['args'] = args or []
         self['kwargs'] = kwargs or {}
         self['ord'] = n_ord
+        self['out_queue'] = out_queue
+        self['cancel'] = cancel
+        self['fail_fast'] = fail_fast
 
 
 class Worker(threading.Thread):
     """
     Class that actually does the work, gets a TaskFunc through the queue,
     runs its function with the passed parameters and returns the result
+    through the output queue of the task, or its own if the task has none.
+    A task whose cancel event is set is not run, and TaskCancelled is
+    returned instead. The event is set when the task fails and its
+    fail_fast is true, or is a function returning true for the exception.
     If the string 'done' is passed instead of a TaskFunc instance, the thread
     will end.
     """
@@ -57,13 +75,180 @@ class Worker(threading.Thread):
             task = self.in_queue.get()
             if task == 'done':
                 return
+            if task['cancel'] is not None and task['cancel'].is_set():
+                res = TaskCancelled()
+            else:
+                try:
+                    res = task['func'](*task['args'],
+                                       **task['kwargs'])
+                except Exception as exc:
+                    res = exc
+                    traceback.print_exc()
+                    fail_fast = task['fail_fast']
+                    if fail_fast and (fail_fast is True or fail_fast(exc)):
+                        logging.debug("Cancelling the remaining tasks after "
+                                      "a failure: %s", exc)
+                        task['cancel'].set()
+            (task['out_queue'] or self.out_queue).put((task['ord'], res))
+
+
+class WorkerPool(object):
+    """
+    Pool of ``n_workers`` Worker threads, or one per core if 0, kept running
+    to run the tasks of successive parallelize calls given the pool, until
+    it is shut down. The threads are only started with the first tasks.
+
+    Several threads may run tasks on the pool at once, but the tasks must
+    not use the pool themselves, as they could end up waiting for each
+    other.
+    """
+    def __init__(self, n_workers=0):
+        self.n_workers = n_workers or cpu_count()
+        self.in_queue = queue.Queue()
+        self.workers = []
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self.workers:
+                return
+            logging.debug("Running parallel %d workers", self.n_workers)
+            for n_worker in range(self.n_workers):
+                new_worker = Worker(self.in_queue, None)
+                new_worker.daemon = True
+                logging.debug("Spawning worker %d", n_worker)
+                new_worker.start()
+                self.workers.append(new_worker)
+
+    def map(self, func, args, kwargs, p_kwargs, fail_fast=None):
+        """Run ``func(*args, **kwargs)`` on the workers once for each dict of
+        keyword arguments of ``p_kwargs`` added to ``kwargs``, and return the
+        results in the same order, with the exception raised by a failed run
+        in place of its result.
+        """
+        return list(self.imap(func, args, kwargs, p_kwargs, fail_fast))
+
+    def imap(self, func, args, kwargs, p_kwargs, fail_fast=None):
+        """Like map(), but return a generator yielding each result as soon
+        as it and those before it are ready. The runs are queued right away.
+
+        If ``fail_fast`` is true, or is a function returning true for the
+        exception raised by a run, the runs that did not start yet are
+        cancelled after that failure, and TaskCancelled is yielded in place
+        of their results. The runs that did not start yet are also cancelled
+        when the generator is closed before the end.
+        """
+        self._start()
+        out_queue = queue.Queue()
+        cancel = threading.Event()
+        # Feed the workers
+        n_ord = 0
+        for f_kwargs in p_kwargs:
+            f_kwargs.update(kwargs)
+            self.in_queue.put(TaskFunc(n_ord, func, args, f_kwargs,
+                                       out_queue, cancel, fail_fast))
+            n_ord += 1
+        return self._results(out_queue, cancel, n_ord)
+
+    @staticmethod
+    def _results(out_queue, cancel, n_tasks):
+        # Wait for the results, yielding them in order
+        logging.debug("Waiting for workers to finish processing")
+        ready = {}
+        try:
+            for n_ord in range(n_tasks):
+                while n_ord not in ready:
+                    r_ord, res = out_queue.get()
+                    ready[r_ord] = res
+                yield ready.pop(n_ord)
+        finally:
+            cancel.set()
+
+    def pipeline(self, func, p_kwargs, depth, fail_fast=None):
+        """Like imap(), but for the dicts of keyword arguments produced by
+        the iterable ``p_kwargs``, consumed from a thread of its own while
+        the workers run the tasks already produced.
+
+        At most ``depth`` tasks are produced ahead of the results yielded,
+        so that producing the arguments overlaps the runs while holding a
+        bounded number of them at once. Producing stops once the generator
+        is closed, or once a run is cancelled. An exception raised by
+        ``p_kwargs`` is raised by the generator after yielding the results
+        of the tasks produced before it.
+        """
+        self._start()
+        out_queue = queue.Queue()
+        cancel = threading.Event()
+        slots = threading.Semaphore(depth)
+
+        def feed():
+            n_ord = 0
+            error = None
+            p_iter = iter(p_kwargs)
             try:
-                res = task['func'](*task['args'],
-                                   **task['kwargs'])
+                while True:
+                    # wait for the results to be consumed before producing
+                    # the next task
+                    slots.acquire()
+                    if cancel.is_set():
+                        break
+                    try:
+                        f_kwargs = next(p_iter)
+                    except StopIteration:
+                        break
+                    self.in_queue.put(TaskFunc(n_ord, func, None, f_kwargs,
+                                               out_queue, cancel, fail_fast))
+                    n_ord += 1
             except Exception as exc:
-                res = exc
-                traceback.print_exc()
-            self.out_queue.put((task['ord'], res))
+                error = exc
+            finally:
+                if hasattr(p_iter, 'close'):
+                    p_iter.close()
+            # tell how many tasks were produced
+            out_queue.put((None, (n_ord, error)))
+
+        feeder = threading.Thread(target=feed)
+        feeder.daemon = True
+        feeder.start()
+        return self._pipeline_results(out_queue, cancel, slots, depth,
+                                      feeder)
+
+    @staticmethod
+    def _pipeline_results(out_queue, cancel, slots, depth, feeder):
+        ready = {}
+        n_tasks = None
+        error = None
+        n_ord = 0
+        try:
+            while n_tasks is None or n_ord < n_tasks:
+                if n_ord in ready:
+                    res = ready.pop(n_ord)
+                    n_ord += 1
+                    slots.release()
+                    yield res
+                    continue
+                r_ord, res = out_queue.get()
+                if r_ord is None:
+                    n_tasks, error = res
+                else:
+                    ready[r_ord] = res
+        finally:
+            cancel.set()
+            # unblock the feeder if it waits for a slot
+            for _ in range(depth):
+                slots.release()
+            feeder.join()
+        if error is not None:
+            raise error
+
+    def shutdown(self):
+        """Stop the workers once they have run the tasks already queued."""
+        with self._lock:
+            workers, self.workers = self.workers, []
+            for _ in workers:
+                self.in_queue.put('done')
+            for worker in workers:
+                worker.join()
 
 
 def parallelize(func):
@@ -81,6 +266,13 @@ def parallelize(func):
         passed will autodetect the number of cores and use that, if '1'
         passed, it will not use any workers and just run as if were not
         parallelized everything.
+        :arg WorkerPool pool: pool whose workers run the function, instead of
+        workers spawned for this call, in which case n_workers is ignored.
+        :arg bool stream: return a generator yielding the results in order
+        as soon as they are ready, instead of a list.
+        :arg fail_fast: cancel the runs that did not start yet after a run
+        fails, or after a run raises an exception for which this function
+        returns true, see WorkerPool.imap.
 
         Example:
 
@@ -104,48 +296,246 @@ def parallelize(func):
         """
         n_workers = kwargs.pop('n_workers', 0)
         p_kwargs = kwargs.pop('parallelize', [])
+        pool = kwargs.pop('pool', None)
+        stream = kwargs.pop('stream', False)
+        fail_fast = kwargs.pop('fail_fast', None)
         # if only one parameter is passed inside the parallelize dict, run the
         # original function as is, no need for pools
         if len(p_kwargs) == 1:
             kwargs.update(p_kwargs[0])
         if len(p_kwargs) in (1, 0):
-            return func(*args, **kwargs)
-
-        # prepare the workers
-        # If no number of workers passed or passed 0
-        if not n_workers:
-            n_workers = cpu_count()
-        logging.debug("Running parallel %d workers", n_workers)
-        worker_pool = []
-        in_queue = queue.Queue()
-        out_queue = queue.Queue()
-        for n_worker in range(n_workers):
-            new_worker = Worker(in_queue, out_queue)
-            new_worker.setDaemon(True)
-            logging.debug("Spawning worker %d", n_worker)
-            new_worker.start()
-            worker_pool.append(new_worker)
+            result = func(*args, **kwargs)
+            return iter([result]) if stream else result
 
-        # Feed the workers
-        n_ord = 0
-        for f_kwargs in p_kwargs:
-            f_kwargs.update(kwargs)
-            in_queue.put(TaskFunc(n_ord, func, args, f_kwargs))
-            n_ord += 1
-        for _ in range(n_workers):
-            in_queue.put('done')
-
-        # Wait for the results
-        logging.debug("Waiting for workers to finish processing")
-        results = []
-        for _ in p_kwargs:
-            new_res = out_queue.get()
-            results.append(new_res)
-        # cleanup
-        for worker in worker_pool:
-            worker.join()
-        # Reorder the results
-        results = [r[1] for r in sorted(results)]
+        if stream:
+            return _stream(func, args, kwargs, p_kwargs, n_workers, pool,
+                           fail_fast)
+        if pool is not None:
+            results = pool.map(func, args, kwargs, p_kwargs, fail_fast)
+        else:
+            # prepare workers for this call only
+            pool = WorkerPool(n_workers)
+            try:
+                results = pool.map(func, args, kwargs, p_kwargs, fail_fast)
+            finally:
+                pool.shutdown()
         logging.debug("Parallel task finished")
         return results
     return parallelized
+
+
+def _stream(func, args, kwargs, p_kwargs, n_workers, pool, fail_fast):
+    own_pool = pool is None
+    if own_pool:
+        # prepare workers for this call only
+        pool = WorkerPool(n_workers)
+    results = pool.imap(func, args, kwargs, p_kwargs, fail_fast)
+    try:
+        for result in results:
+            yield result
+    finally:
+        # cancel the runs left if closed early, before waiting for the
+        # workers to stop
+        results.close()
+        if own_pool:
+            pool.shutdown()
+    logging.debug("Parallel task finished")
+
+
+# upper bounds in seconds of the buckets of the latency histogram
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _percentile(values, percent):
+    values = sorted(values)
+    return values[max(0, int(math.ceil(len(values) * percent / 100.0)) - 1)]
+
+
+class AdaptiveLimiter(object):
+    """
+    Limits the number of tasks run at once, starting from ``initial`` and
+    raised by one whenever the 95th percentile of the latencies of the last
+    round of tasks stays under ``latency_target`` seconds, up to
+    ``max_limit``. The limit is cut by a quarter when that percentile goes
+    over the target, and halved as soon as a task reports an overload.
+
+    When ``max_rps`` is given, tasks are also started at most that many
+    times per second.
+    """
+    def __init__(self, max_limit, latency_target, max_rps=None, initial=2):
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.min_interval = 1.0 / max_rps if max_rps else 0
+        self.limit = min(initial, max_limit)
+        self.in_flight = 0
+        self.next_start = 0
+        self.window = []
+        self.samples = []
+        self.started = time.time()
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while self.in_flight >= self.limit:
+                self.cond.wait()
+            self.in_flight += 1
+            now = time.time()
+            start = max(now, self.next_start)
+            self.next_start = start + self.min_interval
+        if start > now:
+            time.sleep(start - now)
+        return start
+
+    def release(self, start, overloaded=False):
+        end = time.time()
+        with self.cond:
+            self.in_flight -= 1
+            self.samples.append((end, end - start))
+            self.window.append(end - start)
+            if overloaded:
+                self._set_limit(self.limit // 2, 'overload reported')
+            elif len(self.window) >= self.limit:
+                p95 = _percentile(self.window, 95)
+                if p95 <= self.latency_target:
+                    self._set_limit(self.limit + 1,
+                                    'p95 latency %.3fs' % p95)
+                else:
+                    self._set_limit(self.limit - max(1, self.limit // 4),
+                                    'p95 latency %.3fs' % p95)
+            self.cond.notify_all()
+
+    def _set_limit(self, limit, reason):
+        limit = max(1, min(limit, self.max_limit))
+        if limit != self.limit:
+            logging.debug("Running up to %d tasks at once (%s)",
+                          limit, reason)
+        self.limit = limit
+        self.window = []
+
+    def log_stats(self):
+        if not self.samples:
+            return
+        latencies = [latency for end, latency in self.samples]
+        duration = max(end for end, latency in self.samples) - self.started
+        logging.info("Ran %d tasks in %.3fs (%.1f/s), latency p50 %.3fs, "
+                     "p95 %.3fs, max %.3fs", len(latencies), duration,
+                     len(latencies) / max(duration, 0.001),
+                     _percentile(latencies, 50), _percentile(latencies, 95),
+                     max(latencies))
+
+        per_second = [0] * (int(duration) + 1)
+        for end, latency in self.samples:
+            per_second[int(end - self.started)] += 1
+        logging.info("Tasks completed per second: %s",
+                     " ".join(str(count) for count in per_second))
+
+        histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+        for latency in latencies:
+            bucket = 0
+            while (bucket < len(LATENCY_BUCKETS) and
+                    latency > LATENCY_BUCKETS[bucket]):
+                bucket += 1
+            histogram[bucket] += 1
+        labels = ['<=%ss' % bound for bound in LATENCY_BUCKETS]
+        labels.append('>%ss' % LATENCY_BUCKETS[-1])
+        logging.info("Latency histogram: %s", ", ".join(
+            "%s: %d" % (label, count)
+            for label, count in zip(labels, histogram)))
+
+
+class AdaptiveWorker(threading.Thread):
+    """
+    Worker running the tasks of the queue within the limits set by an
+    AdaptiveLimiter, reporting the tasks whose exception matches
+    ``is_overload`` as overloads.
+
+    A task whose exception matches ``is_transient`` is run again up to
+    ``retries`` times, after an exponential backoff from ``retry_delay``
+    seconds. Each attempt is reported to the limiter, and the backoff is
+    waited for without counting as a task run.
+    """
+    def __init__(self, in_queue, out_queue, limiter, is_overload,
+                 retries=0, retry_delay=1.0, is_transient=None):
+        threading.Thread.__init__(self)
+        self.in_queue = in_queue
+        self.out_queue = out_queue
+        self.limiter = limiter
+        self.is_overload = is_overload
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.is_transient = is_transient
+
+    def run(self):
+        while True:
+            task = self.in_queue.get()
+            if task == 'done':
+                return
+            self.out_queue.put((task['ord'], self.run_task(task)))
+
+    def run_task(self, task):
+        attempt = 0
+        while True:
+            start = self.limiter.acquire()
+            try:
+                res = task['func'](*task['args'],
+                                   **task['kwargs'])
+            except Exception as exc:
+                self.limiter.release(
+                    start, bool(self.is_overload and self.is_overload(exc)))
+                if (attempt >= self.retries or not self.is_transient or
+                        not self.is_transient(exc)):
+                    traceback.print_exc()
+                    return exc
+                # exponential backoff, with jitter so that the tasks
+                # failing together don't all run again at the same time
+                backoff = (self.retry_delay * 2 ** attempt *
+                           random.uniform(0.5, 1.5))
+                attempt += 1
+                logging.warning("Task failed: %s, retrying in %.1fs (%d/%d)",
+                                exc, backoff, attempt, self.retries)
+                time.sleep(backoff)
+                continue
+            self.limiter.release(start)
+            return res
+
+
+def run_adaptive(func, p_kwargs, max_workers, latency_target, max_rps=None,
+                 is_overload=None, retries=0, retry_delay=1.0,
+                 is_transient=None):
+    """
+    Run ``func`` once for each dict of keyword arguments in the list
+    ``p_kwargs``, with a number of runs at once adapted to their latency by
+    an AdaptiveLimiter, up to ``max_workers``. ``is_overload`` is called with
+    the exception raised by a failed run, to tell whether the runs should
+    back off. The runs failing with an exception matching ``is_transient``
+    are retried up to ``retries`` times, see AdaptiveWorker.
+
+    Like parallelize, the results are returned in the same order as the
+    arguments, with the exception raised by a failed run in place of its
+    result. The throughput and latencies are logged once all have run.
+    """
+    if not p_kwargs:
+        return []
+
+    limiter = AdaptiveLimiter(max_workers, latency_target, max_rps)
+    in_queue = queue.Queue()
+    out_queue = queue.Queue()
+    n_workers = min(max_workers, len(p_kwargs))
+    worker_pool = []
+    for n_worker in range(n_workers):
+        new_worker = AdaptiveWorker(in_queue, out_queue, limiter, is_overload,
+                                    retries, retry_delay, is_transient)
+        new_worker.daemon = True
+        new_worker.start()
+        worker_pool.append(new_worker)
+
+    for n_ord, f_kwargs in enumerate(p_kwargs):
+        in_queue.put(TaskFunc(n_ord, func, kwargs=f_kwargs))
+    for _ in range(n_workers):
+        in_queue.put('done')
+
+    results = [out_queue.get() for _ in p_kwargs]
+    for worker in worker_pool:
+        worker.join()
+    limiter.log_stats()
+    return [r[1] for r in sorted(results, key=lambda r: r[0])]
@@ -15,16 +15,23 @@
 
 # Manage JJB yaml feature implementation
 
+import collections
 import copy
 import fnmatch
 import io
 import itertools
 import logging
+import math
+import multiprocessing
+import os
 import pkg_resources
+from string import Formatter
+import time
 
 from jenkins_jobs.constants import MAGIC_MANAGE_STRING
 from jenkins_jobs.errors import JenkinsJobsException
 from jenkins_jobs.formatter import deep_format
+from jenkins_jobs.formatter import LazyFormatDict
 import jenkins_jobs.local_yaml as local_yaml
 from jenkins_jobs.registry import ModuleRegistry
 from jenkins_jobs import utils
@@ -46,6 +53,56 @@ def matches(what, glob_patterns):
                for glob_pattern in glob_patterns)
 
 
+def _glob_literal_affixes(glob_pattern):
+    """Return the literal text every string matching ``glob_pattern``
+    starts and ends with.
+    """
+    wildcards = [i for i, c in enumerate(glob_pattern) if c in '*?[]']
+    if not wildcards:
+        return glob_pattern, glob_pattern
+    return glob_pattern[:wildcards[0]], glob_pattern[wildcards[-1] + 1:]
+
+
+def template_name_may_match(template_name, glob_patterns):
+    """
+    Checks if a job name expanded from the template name ``template_name``
+    could match any of the glob patterns in the iterable ``glob_patterns``,
+    by comparing the literal text at the start and end of the template name
+    with that of each pattern. This only excludes templates that can never
+    match, the expanded names still need to be checked with ``matches``.
+
+    :arg str template_name: name of the template, containing the variables
+        replaced during expansion
+    :arg iterable glob_patterns: glob patterns to match (list, tuple, set,
+        etc.)
+    """
+    try:
+        segments = list(Formatter().parse(template_name))
+    except ValueError:
+        # leave reporting invalid names to the expansion itself
+        return True
+    # escaped braces split the literal text into several segments
+    literals = [literal for literal, _, _, _ in segments]
+    fields = [n for n, (_, field, _, _) in enumerate(segments)
+              if field is not None]
+    if not fields:
+        return matches(''.join(literals), glob_patterns)
+    prefix = os.path.normcase(''.join(literals[:fields[0] + 1]))
+    suffix = os.path.normcase(''.join(literals[fields[-1] + 1:]))
+
+    for glob_pattern in glob_patterns:
+        glob_prefix, glob_suffix = _glob_literal_affixes(
+            os.path.normcase(glob_pattern))
+        if not (prefix.startswith(glob_prefix) or
+                glob_prefix.startswith(prefix)):
+            continue
+        if not (suffix.endswith(glob_suffix) or
+                glob_suffix.endswith(suffix)):
+            continue
+        return True
+    return False
+
+
 def combination_matches(combination, match_combinations):
     """
     Checks if the given combination is matches for any of the given combination
@@ -61,20 +118,73 @@ def combination_matches(combination, match_combinations):
     (key1=2, key2=2)
     """
     for cmatch in match_combinations:
-        for key, val in combination.items():
-            if cmatch.get(key, val) != val:
+        for key, val in cmatch.items():
+            if key in combination and combination[key] != val:
                 break
         else:
             return True
     return False
 
 
+def load_yaml_file(fn, search_path, yaml_cache=None):
+    """Load the yaml file ``fn``, through ``yaml_cache`` when given one.
+
+    This is kept separate from the parser so that it can be run in worker
+    processes, with the results added to the parser afterwards.
+    """
+    if yaml_cache is not None:
+        return yaml_cache.load(fn, search_path)
+    with io.open(fn, 'r', encoding='utf-8') as fp:
+        # wrap provided file streams to ensure correct encoding used
+        return local_yaml.load(utils.wrap_stream(fp), search_path=search_path)
+
+
+# parser of the worker processes generating the XML of the jobs
+_xml_worker_parser = None
+
+
+def _init_xml_worker(config, plugins_info, data):
+    global _xml_worker_parser
+    _xml_worker_parser = YamlParser(config, plugins_info)
+    _xml_worker_parser.data = data
+
+
+def _generate_xml(jobs):
+    """Return the name, output and md5 of the XML generated for each of
+    ``jobs`` by the parser of the worker process, or None for the jobs of an
+    unknown project type.
+    """
+    results = []
+    for data in jobs:
+        job = _xml_worker_parser.getXMLForJob(data)
+        if job is None:
+            results.append(None)
+        else:
+            results.append((job.name, job.output(), job.md5()))
+    return results
+
+
+def _imap_bounded(pool, func, iterable, max_pending):
+    """Like ``pool.imap(func, iterable)``, but only submitting the next
+    call once the result of an earlier one was consumed, so that at most
+    ``max_pending`` calls are run or their results held ahead.
+    """
+    args = iter(iterable)
+    pending = collections.deque(pool.apply_async(func, (arg,))
+                                for arg in itertools.islice(args, max_pending))
+    while pending:
+        yield pending.popleft().get()
+        for arg in itertools.islice(args, 1):
+            pending.append(pool.apply_async(func, (arg,)))
+
+
 class YamlParser(object):
-    def __init__(self, config=None, plugins_info=None):
+    def __init__(self, config=None, plugins_info=None, yaml_cache=None):
         self.data = {}
         self.jobs = []
         self.xml_jobs = []
         self.config = config
+        self.plugins_info = plugins_info
         self.registry = ModuleRegistry(self.config, plugins_info)
         self.path = ["."]
         if self.config:
@@ -83,6 +193,11 @@ class YamlParser(object):
                 self.path = config.get('job_builder',
                                        'include_path').split(':')
         self.keep_desc = self.get_keep_desc()
+        self.yaml_cache = yaml_cache
+        # entries of self.data to visit and changes reported by the module
+        # running handle_data(), see changed_data() and mark_data_changed()
+        self._data_to_visit = None
+        self._data_changes = None
 
     def get_keep_desc(self):
         keep_desc = False
@@ -95,12 +210,17 @@ class YamlParser(object):
     def parse_fp(self, fp):
         # wrap provided file streams to ensure correct encoding used
         data = local_yaml.load(utils.wrap_stream(fp), search_path=self.path)
+        self.parse_data(data, getattr(fp, 'name', fp))
+
+    def parse_data(self, data, fname):
+        """Add the data loaded from the yaml file ``fname``, as returned by
+        :py:func:`load_yaml_file`.
+        """
         if data:
             if not isinstance(data, list):
                 raise JenkinsJobsException(
                     "The topmost collection in file '{fname}' must be a list,"
-                    " not a {cls}".format(fname=getattr(fp, 'name', fp),
-                                          cls=type(data)))
+                    " not a {cls}".format(fname=fname, cls=type(data)))
             for item in data:
                 cls, dfn = next(iter(item.items()))
                 group = self.data.get(cls, {})
@@ -119,13 +239,12 @@ class YamlParser(object):
                 if id in group:
                     self._handle_dups(
                         "Duplicate entry found in '{0}: '{1}' already "
-                        "defined".format(fp.name, id))
+                        "defined".format(fname, id))
                 group[id] = dfn
                 self.data[cls] = group
 
     def parse(self, fn):
-        with io.open(fn, 'r', encoding='utf-8') as fp:
-            self.parse_fp(fp)
+        self.parse_data(load_yaml_file(fn, self.path, self.yaml_cache), fn)
 
     def _handle_dups(self, message):
 
@@ -152,22 +271,27 @@ class YamlParser(object):
         return self.applyDefaults(job)
 
     def applyDefaults(self, data, override_dict=None):
+        """Return a new dict with the values of ``data`` layered over the
+        defaults it refers to, where any of those defaults are first
+        overridden by the matching keys in ``override_dict``.
+
+        The values are shared with the defaults rather than copied, so they
+        must not be modified in place.
+        """
         if override_dict is None:
             override_dict = {}
 
         whichdefaults = data.get('defaults', 'global')
-        defaults = copy.deepcopy(self.data.get('defaults',
-                                 {}).get(whichdefaults, {}))
+        defaults = self.data.get('defaults', {}).get(whichdefaults, {})
         if defaults == {} and whichdefaults != 'global':
             raise JenkinsJobsException("Unknown defaults set: '{0}'"
                                        .format(whichdefaults))
 
-        for key in override_dict.keys():
-            if key in defaults.keys():
-                defaults[key] = override_dict[key]
-
         newdata = {}
         newdata.update(defaults)
+        for key in override_dict.keys():
+            if key in defaults:
+                newdata[key] = override_dict[key]
         newdata.update(data)
         return newdata
 
@@ -180,21 +304,100 @@ class YamlParser(object):
             job["description"] = description + \
                 self.get_managed_string().lstrip()
 
-    def expandYaml(self, jobs_glob=None):
+    def changed_data(self, section):
+        """Return a dict of the entries of the top-level ``section`` of
+        the data that the module running handle_data() needs to visit.
+
+        Modules declaring the sections they read are only given the entries
+        changed since they last ran, otherwise all the entries are returned.
+        """
+        entries = self.data.get(section, {})
+        if self._data_to_visit is None:
+            return entries
+        names = self._data_to_visit.get(section, set())
+        if names is None:
+            return entries
+        return dict((name, entries[name]) for name in names
+                    if name in entries)
+
+    def mark_data_changed(self, section, name):
+        """Record that handle_data() changed the entry ``name`` of the
+        top-level ``section`` of the data.
+
+        Modules that return ``True`` from handle_data() without marking any
+        entries are assumed to have changed every section they write.
+        """
+        if self._data_changes is not None:
+            self._data_changes.setdefault(section, set()).add(name)
+
+    def _handle_data(self):
+        """Run the handle_data() method of the modules until none of them
+        changes the data any more.
+
+        Modules declaring the sections they read with ``data_reads`` are
+        skipped when nothing they read has changed since they last ran.
+        """
+        modules = [module for module in self.registry.modules
+                   if hasattr(module, 'handle_data')]
+        # changes not yet seen by each module, None for everything
+        pending = [None] * len(modules)
+        passes = 0
+        start = time.time()
         changed = True
         while changed:
             changed = False
-            for module in self.registry.modules:
-                if hasattr(module, 'handle_data'):
-                    if module.handle_data(self):
-                        changed = True
+            passes += 1
+            pass_start = time.time()
+            for index, module in enumerate(modules):
+                reads = getattr(module, 'data_reads', None)
+                if reads is None:
+                    self._data_to_visit = None
+                else:
+                    self._data_to_visit = pending[index]
+                    if self._data_to_visit is not None and \
+                            not any(section in self._data_to_visit
+                                    for section in reads):
+                        continue
+                pending[index] = {}
+                self._data_changes = {}
+                try:
+                    if not module.handle_data(self):
+                        continue
+                    changes = self._data_changes
+                finally:
+                    self._data_to_visit = None
+                    self._data_changes = None
+                changed = True
+
+                if not changes:
+                    writes = getattr(module, 'data_writes', None)
+                    if writes is None:
+                        writes = list(self.data.keys())
+                    changes = dict((section, None) for section in writes)
+                for seen in pending:
+                    if seen is None:
+                        continue
+                    for section, names in changes.items():
+                        if names is None or seen.get(section, ()) is None:
+                            seen[section] = None
+                        else:
+                            seen.setdefault(section, set()).update(names)
+            logger.debug("handle_data pass {0} took {1:.3f}s".format(
+                passes, time.time() - pass_start))
+        logger.debug("handle_data reached a fixpoint after {0} passes in "
+                     "{1:.3f}s".format(passes, time.time() - start))
+
+    def expandYaml(self, jobs_glob=None):
+        self._handle_data()
 
         for job in self.data.get('job', {}).values():
             if jobs_glob and not matches(job['name'], jobs_glob):
                 logger.debug("Ignoring job {0}".format(job['name']))
                 continue
             logger.debug("Expanding job '{0}'".format(job['name']))
-            job = self.applyDefaults(job)
+            # jobs are modified while generating the XML, so take a copy of
+            # the values shared with the defaults
+            job = copy.deepcopy(self.applyDefaults(job))
             self.formatDescription(job)
             self.jobs.append(job)
         for project in self.data.get('project', {}).values():
@@ -277,6 +480,11 @@ class YamlParser(object):
     def expandYamlForTemplateJob(self, project, template, jobs_glob=None):
         dimensions = []
         template_name = template['name']
+        if jobs_glob and not template_name_may_match(template_name,
+                                                     jobs_glob):
+            logger.debug("Ignoring job-template '{0}'".format(template_name))
+            return
+
         # reject keys that are not useful during yaml expansion
         for k in ['jobs']:
             project.pop(k)
@@ -292,9 +500,14 @@ class YamlParser(object):
         if len(dimensions) == 0:
             dimensions = [(("", ""),)]
 
+        # project and defaults are the same for every combination, so only
+        # merge them once. Each combination then layers its own values on a
+        # shallow copy, and only the parameters looked up are formatted,
+        # which creates new values leaving the layers underneath untouched.
+        base_params = self.applyDefaults(project, template)
+
         for values in itertools.product(*dimensions):
-            params = copy.deepcopy(project)
-            params = self.applyDefaults(params, template)
+            params = dict(base_params)
 
             expanded_values = {}
             for (k, v) in values:
@@ -306,7 +519,7 @@ class YamlParser(object):
                     expanded_values[k] = v
 
             params.update(expanded_values)
-            params = deep_format(params, params)
+            params = LazyFormatDict(params)
             if combination_matches(params, excludes):
                 logger.debug('Excluding combination %s', str(params))
                 continue
@@ -323,12 +536,14 @@ class YamlParser(object):
                     params[key] = template[key]
 
             params['template-name'] = template_name
+            if jobs_glob:
+                # check the name before expanding the rest of the template
+                job_name = deep_format(template_name, params,
+                                       allow_empty_variables)
+                if not matches(job_name, jobs_glob):
+                    continue
             expanded = deep_format(template, params, allow_empty_variables)
 
-            job_name = expanded.get('name')
-            if jobs_glob and not matches(job_name, jobs_glob):
-                continue
-
             self.formatDescription(expanded)
             self.jobs.append(expanded)
 
@@ -337,16 +552,73 @@ class YamlParser(object):
         # project does not otherwise have a description.
         return "\n\n" + MAGIC_MANAGE_STRING
 
-    def generateXML(self):
-        for job in self.jobs:
-            self.xml_jobs.append(self.getXMLForJob(job))
+    def generateXML(self, n_workers=None):
+        """Generate the XML of every job into xml_jobs.
+
+        :arg int n_workers: number of worker processes generating the XML of
+            shards of the jobs, each with its own module registry, '0' to
+            use one per core. By default, or if '1' is passed, the XML is
+            generated in the current process. Either way xml_jobs holds the
+            jobs in the same order, with the same output.
+        """
+        self.xml_jobs.extend(self.iterXML(n_workers))
+
+    def iterXML(self, n_workers=None, max_ahead=None):
+        """Return a generator yielding the XML of every job as it is
+        generated, in the order of the jobs, see generateXML().
+
+        When generated in the current process, the XML of a job is only
+        generated once the previous one was consumed. Otherwise the worker
+        processes are started right away, from the calling thread, and if
+        ``max_ahead`` is given, at most that many jobs are generated ahead of
+        those consumed.
+        """
+        if n_workers in (None, 1) or len(self.jobs) < 2:
+            return (self.getXMLForJob(job) for job in self.jobs)
+
+        n_workers = n_workers or multiprocessing.cpu_count()
+        if max_ahead:
+            # shards small enough for all the workers to run one at once
+            shard_size = max(1, max_ahead // n_workers)
+        else:
+            # a few shards per worker to even out their load, while keeping
+            # the number of round-trips low
+            shard_size = int(math.ceil(len(self.jobs) /
+                                       float(n_workers * 4)))
+        shards = [self.jobs[n:n + shard_size]
+                  for n in range(0, len(self.jobs), shard_size)]
+        logger.debug("Generating XML with %d workers in %d shards",
+                     n_workers, len(shards))
+        pool = multiprocessing.Pool(
+            n_workers, _init_xml_worker,
+            (self.config, self.plugins_info, self.data))
+        if max_ahead:
+            results = _imap_bounded(pool, _generate_xml, shards,
+                                    max(1, max_ahead // shard_size))
+        else:
+            results = pool.imap(_generate_xml, shards)
+        return self._iter_pool_xml(pool, results)
+
+    @staticmethod
+    def _iter_pool_xml(pool, results):
+        try:
+            for result in itertools.chain.from_iterable(results):
+                if result is None:
+                    yield None
+                else:
+                    name, output, md5 = result
+                    yield XmlJob.from_output(output, name, md5)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
 
     def getXMLForJob(self, data):
         kind = data.get('project-type', 'freestyle')
 
         for ep in pkg_resources.iter_entry_points(
                 group='jenkins_jobs.projects', name=kind):
-            Mod = ep.load()
+            Mod = self.registry.load_entry_point(ep)
             mod = Mod(self.registry)
             xml = mod.root_xml(data)
             self.gen_xml(xml, data)
@@ -29,6 +29,8 @@ logger = logging.getLogger(__name__)
 
 class ModuleRegistry(object):
     entry_points_cache = {}
+    # objects of the entry points already loaded, by entry point definition
+    loaded_entry_points = {}
 
     def __init__(self, config, plugins_list=None):
         self.modules = []
@@ -44,13 +46,25 @@ class ModuleRegistry(object):
 
         for entrypoint in pkg_resources.iter_entry_points(
                 group='jenkins_jobs.modules'):
-            Mod = entrypoint.load()
+            Mod = self.load_entry_point(entrypoint)
             mod = Mod(self)
             self.modules.append(mod)
             self.modules.sort(key=operator.attrgetter('sequence'))
             if mod.component_type is not None:
                 self.modules_by_component_type[mod.component_type] = entrypoint
 
+    @classmethod
+    def load_entry_point(cls, entry_point):
+        """Return the object of ``entry_point``, loading it only the first
+        time, as loading checks the requirements of its distribution again
+        every time.
+        """
+        key = str(entry_point)
+        obj = cls.loaded_entry_points.get(key)
+        if obj is None:
+            obj = cls.loaded_entry_points[key] = entry_point.load()
+        return obj
+
     @staticmethod
     def _get_plugins_info_dict(plugins_list):
         def mutate_plugin_info(plugin_info):
@@ -145,7 +159,8 @@ class ModuleRegistry(object):
                                        "'{0}'.".format(component_type))
 
         entry_point = self.modules_by_component_type[component_type]
-        component_list_type = entry_point.load().component_list_type
+        component_list_type = self.load_entry_point(
+            entry_point).component_list_type
 
         if isinstance(component, dict):
             # The component is a singleton dictionary of name: dict(args)
@@ -241,7 +256,7 @@ class ModuleRegistry(object):
                 self.dispatch(component_type,
                               parser, xml_parent, b, component_data)
         elif name in eps:
-            func = eps[name].load()
+            func = self.load_entry_point(eps[name])
             func(parser, xml_parent, component_data)
         else:
             raise JenkinsJobsException("Unknown entry point or macro '{0}' "
@@ -16,9 +16,18 @@
 # Manage Jenkins XML config file output.
 
 import hashlib
-from xml.dom import minidom
+import io
+import re
 import xml.etree.ElementTree as XML
 
+import six
+
+from jenkins_jobs.errors import JenkinsJobsException
+
+# characters not allowed in XML 1.0 documents, even escaped
+INVALID_XML_CHARS_RE = re.compile(
+    u'[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+
 
 def remove_ignorable_whitespace(node):
     """Remove insignificant whitespace from XML nodes
@@ -42,14 +51,126 @@ def remove_ignorable_whitespace(node):
         remove_ignorable_whitespace(child)
 
 
+def _escape(data):
+    if not isinstance(data, six.string_types):
+        raise TypeError("cannot serialize %r (type %s)" %
+                        (data, type(data).__name__))
+    match = INVALID_XML_CHARS_RE.search(data)
+    if match:
+        raise ValueError("invalid XML character %r in %r" %
+                         (match.group(), data))
+    return data.replace(u'&', u'&amp;').replace(u'<', u'&lt;').replace(
+        u'"', u'&quot;').replace(u'>', u'&gt;')
+
+
+def _escape_text(text):
+    # line endings in text are normalized by XML parsers, as was done when
+    # the output used to be parsed again to be indented
+    return _escape(text).replace(u'\r\n', u'\n').replace(u'\r', u'\n')
+
+
+def _write_pretty(write, node, indent=u'', addindent=u'  ', newl=u'\n'):
+    """Write out the element ``node`` and its sub elements, indented with
+    ``addindent`` for each level.
+
+    Elements containing only text are written on a single line, otherwise
+    any text and tails are written on lines of their own, matching the
+    output of ``xml.dom.minidom``'s ``toprettyxml``. Attributes are sorted
+    by name to keep the output stable across python versions.
+    """
+    write(u'%s<%s' % (indent, node.tag))
+    for name in sorted(node.keys()):
+        write(u' %s="%s"' % (name, _escape(node.get(name))))
+
+    if not len(node):
+        if node.text:
+            write(u'>%s</%s>%s' % (_escape_text(node.text), node.tag, newl))
+        else:
+            write(u'/>%s' % newl)
+        return
+
+    write(u'>%s' % newl)
+    subindent = indent + addindent
+    if node.text:
+        write(u'%s%s%s' % (subindent, _escape_text(node.text), newl))
+    for child in node:
+        _write_pretty(write, child, subindent, addindent, newl)
+        if child.tail:
+            write(u'%s%s%s' % (subindent, _escape_text(child.tail), newl))
+    write(u'%s</%s>%s' % (indent, node.tag, newl))
+
+
+def normalized_md5(xml):
+    """Return the md5 of the XML document ``xml``, given as text or bytes,
+    ignoring its declaration line and the whitespace between elements.
+
+    Documents differing only in their formatting, such as the configuration
+    generated for a job and the one Jenkins stored for it, get the same md5.
+    """
+    if isinstance(xml, six.text_type):
+        xml = xml.encode('utf-8')
+    node = XML.fromstring(xml)
+    remove_ignorable_whitespace(node)
+    out = io.StringIO()
+    _write_pretty(out.write, node)
+    return hashlib.md5(out.getvalue().encode('utf-8')).hexdigest()
+
+
 class XmlJob(object):
     def __init__(self, xml, name):
         self.xml = xml
         self.name = name
 
+    @classmethod
+    def from_output(cls, output, name, md5=None):
+        """Return the job named ``name`` whose XML was already generated as
+        ``output``, with the given ``md5``, such as by another process. Its
+        XML tree is only parsed back from the output when accessed.
+        """
+        job = cls(None, name)
+        job._output = output
+        job._md5 = md5
+        return job
+
+    @property
+    def xml(self):
+        if self._xml is None and self._output is not None:
+            self._xml = XML.fromstring(self._output)
+            remove_ignorable_whitespace(self._xml)
+        return self._xml
+
+    @xml.setter
+    def xml(self, xml):
+        self._xml = xml
+        self.invalidate()
+
+    def invalidate(self):
+        """Discard the memoized output, must be called after modifying the
+        XML tree in place once the output has been generated.
+        """
+        self._output = None
+        self._md5 = None
+        self._normalized_md5 = None
+
     def md5(self):
-        return hashlib.md5(self.output()).hexdigest()
+        if self._md5 is None:
+            self._md5 = hashlib.md5(self.output()).hexdigest()
+        return self._md5
+
+    def normalized_md5(self):
+        if self._normalized_md5 is None:
+            self._normalized_md5 = normalized_md5(self.output())
+        return self._normalized_md5
 
     def output(self):
-        out = minidom.parseString(XML.tostring(self.xml, encoding='UTF-8'))
-        return out.toprettyxml(indent='  ', encoding='utf-8')
+        if self._output is None:
+            out = io.StringIO()
+            out.write(u'<?xml version="1.0" encoding="utf-8"?>\n')
+            try:
+                _write_pretty(out.write, self.xml)
+            except ValueError as e:
+                raise JenkinsJobsException(
+                    "Cannot generate the XML of job '%s': %s" %
+                    (self.name, e))
+            self._output = out.getvalue().encode('utf-8')
+        return self._output
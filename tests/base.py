@@ -17,6 +17,7 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import base64
 import doctest
 import io
 import json
@@ -24,11 +25,17 @@ import logging
 import operator
 import os
 import re
+import threading
 import xml.etree.ElementTree as XML
 
 import fixtures
+from six.moves import BaseHTTPServer
 from six.moves import configparser
+from six.moves import socketserver
 from six.moves import StringIO
+from six.moves.urllib.parse import parse_qs
+from six.moves.urllib.parse import unquote
+from six.moves.urllib.parse import urlparse
 import testtools
 from testtools.content import text_content
 from yaml import safe_dump
@@ -107,6 +114,162 @@ class LoggingFixture(object):
         self.useFixture(fixtures.FakeLogger(level=logging.DEBUG))
 
 
+class JenkinsServerFixture(fixtures.Fixture):
+    """
+    Minimal stub of the Jenkins HTTP API served from a local thread, giving
+    access to the jobs and configurations of ``jobs``, a dict of job names
+    to config.xml contents.
+
+    The descriptions of the jobs in ``hide_descriptions`` are left out of
+    the json API, and a crumb is issued when ``crumb`` is set. Every request
+    is recorded as a (method, path) tuple in ``requests``, and the address
+    of every client connection in ``connections``.
+
+    The scripts run on the script console are expected to be batch updates
+    from the builder, whose jobs are created or updated unless their
+    configuration is not valid XML.
+    """
+
+    def __init__(self, jobs=None, hide_descriptions=(), crumb=None):
+        super(JenkinsServerFixture, self).__init__()
+        self.jobs = dict(jobs or {})
+        self.hide_descriptions = set(hide_descriptions)
+        self.crumb = crumb
+        self.requests = []
+        self.connections = set()
+
+    def _setUp(self):
+        fixture = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def setup(self):
+                BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+                fixture.connections.add(self.client_address)
+
+            def _respond(self, code, body=b'', content_type='text/plain'):
+                self.send_response(code)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _job_name(self, path, suffix):
+                if path.startswith('/job/') and path.endswith(suffix):
+                    name = path[len('/job/'):-len(suffix)]
+                    if name in fixture.jobs:
+                        return name
+                return None
+
+            def do_GET(self):
+                fixture.requests.append(('GET', self.path))
+                url = urlparse(self.path)
+                path = unquote(url.path)
+                if path == '/crumbIssuer/api/json' and fixture.crumb:
+                    self._respond(200, json.dumps(
+                        {'crumb': fixture.crumb,
+                         'crumbRequestField': 'Jenkins-Crumb'}
+                    ).encode('utf-8'), 'application/json')
+                elif path == '/api/json':
+                    self._respond(
+                        200, json.dumps(fixture.get_info(unquote(url.query)))
+                        .encode('utf-8'), 'application/json')
+                elif self._job_name(path, '/config.xml'):
+                    name = self._job_name(path, '/config.xml')
+                    self._respond(200, fixture.jobs[name].encode('utf-8'),
+                                  'application/xml')
+                elif self._job_name(path, '/api/json'):
+                    name = self._job_name(path, '/api/json')
+                    self._respond(200, json.dumps({'name': name})
+                                  .encode('utf-8'), 'application/json')
+                else:
+                    self._respond(404)
+
+            def do_POST(self):
+                fixture.requests.append(('POST', self.path))
+                url = urlparse(self.path)
+                path = unquote(url.path)
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length).decode('utf-8')
+                if path == '/createItem':
+                    name = unquote(url.query.split('name=', 1)[1])
+                    if name in fixture.jobs:
+                        self._respond(400)
+                    else:
+                        fixture.jobs[name] = body
+                        self._respond(200)
+                elif self._job_name(path, '/config.xml'):
+                    fixture.jobs[self._job_name(path, '/config.xml')] = body
+                    self._respond(200)
+                elif self._job_name(path, '/doDelete'):
+                    del fixture.jobs[self._job_name(path, '/doDelete')]
+                    self._respond(200)
+                elif path == '/scriptText':
+                    script = parse_qs(body)['script'][0]
+                    self._respond(200, fixture.run_script(script)
+                                  .encode('utf-8'))
+                else:
+                    self._respond(404)
+
+        class Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d/' % self.server.server_address[1]
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  kwargs={'poll_interval': 0.05})
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def run_script(self, script):
+        output = []
+        entries = re.findall(r"^\['([^']*)', '([^']*)'\],?$", script, re.M)
+        for n_ord, (name, xml) in enumerate(entries):
+            name = base64.b64decode(name).decode('utf-8')
+            xml = base64.b64decode(xml).decode('utf-8')
+            try:
+                XML.fromstring(xml.encode('utf-8'))
+            except XML.ParseError as e:
+                output.append('jjb-status %d failed %s' % (
+                    n_ord, base64.b64encode(str(e).encode('utf-8'))
+                    .decode('ascii')))
+                continue
+            output.append('jjb-status %d %s' % (
+                n_ord, 'updated' if name in self.jobs else 'created'))
+            self.jobs[name] = xml
+        output = '\n'.join(output) + '\n'
+        # python-jenkins appends a print of a marker to check the script ran
+        # to completion
+        marker = re.search(r'^print\("(.*)"\)$', script, re.M)
+        if marker:
+            output += marker.group(1)
+        return output
+
+    def get_description(self, name):
+        description = XML.fromstring(self.jobs[name]).find('.//description')
+        if description is None:
+            return None
+        return description.text
+
+    def get_info(self, query):
+        jobs = []
+        for name in sorted(self.jobs):
+            job = {'name': name, 'url': self.url + 'job/%s/' % name,
+                   'color': 'blue'}
+            if 'description' in query and \
+                    name not in self.hide_descriptions:
+                job['description'] = self.get_description(name)
+            jobs.append(job)
+        return {'jobs': jobs}
+
+
 class BaseTestCase(LoggingFixture):
     scenarios = []
     fixtures_path = None
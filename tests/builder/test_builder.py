@@ -14,10 +14,48 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import errno
+import io
+import logging
+import multiprocessing
+import os
+import re
+import socket
+import threading
+import time
+from xml.sax.saxutils import escape
+
+import fixtures
+import requests
+from six.moves import configparser
+from six.moves import StringIO
+from testtools import ExpectedException
+from testtools.matchers import LessThan
+from testtools.matchers import MatchesRegex
+from testtools import TestCase
+
 import jenkins_jobs.builder
+import jenkins_jobs.parallel
+import jenkins_jobs.parser
+from jenkins_jobs.cmd import DEFAULT_CONF
+from jenkins_jobs.constants import MAGIC_MANAGE_STRING
+from jenkins_jobs.errors import JenkinsJobsException
+from jenkins_jobs.xml_config import XmlJob
+from tests.base import JenkinsServerFixture
 from tests.base import LoggingFixture
 from tests.base import mock
-from testtools import TestCase
+
+
+_generate_xml = jenkins_jobs.parser._generate_xml
+# number of jobs the worker processes started generating the XML of, shared
+# with them as they are forked
+_generated_jobs = None
+
+
+def _count_generated_xml(jobs):
+    with _generated_jobs.get_lock():
+        _generated_jobs.value += len(jobs)
+    return _generate_xml(jobs)
 
 
 @mock.patch('jenkins_jobs.builder.CacheStorage', mock.MagicMock)
@@ -39,3 +77,729 @@ class TestCaseTestBuilder(LoggingFixture, TestCase):
         # Trigger fetching the plugins from jenkins when accessing the property
         self.builder._plugins_list = None
         self.assertEqual(self.builder.plugins_list, ['p1', 'p2'])
+
+
+class TestCaseTestBuilderLoadFiles(LoggingFixture, TestCase):
+    def setUp(self):
+        super(TestCaseTestBuilderLoadFiles, self).setUp()
+        cache_patch = mock.patch('jenkins_jobs.builder.CacheStorage',
+                                 mock.MagicMock)
+        cache_patch.start()
+        self.addCleanup(cache_patch.stop)
+
+        self.config = configparser.ConfigParser()
+        self.config.readfp(StringIO(DEFAULT_CONF))
+        self.builder = jenkins_jobs.builder.Builder(
+            'http://jenkins.example.com',
+            'doesnot', 'matter',
+            config=self.config,
+            plugins_list=[],
+        )
+
+        tmpdir = self.useFixture(fixtures.TempDir()).path
+        self.files = []
+        for n in range(4):
+            fn = os.path.join(tmpdir, 'jobs%d.yaml' % n)
+            with io.open(fn, 'w', encoding='utf-8') as f:
+                f.write(u"- job:\n    name: job%d\n"
+                        u"- job:\n    name: duplicate\n"
+                        u"    description: from file %d\n" % (n, n))
+            self.files.append(fn)
+
+    def test_parallel_parse_same_as_serial(self):
+        self.config.set('job_builder', 'allow_duplicates', 'True')
+        self.builder.load_files(self.files, n_workers=1)
+        expected = self.builder.parser.data
+        self.builder.load_files(self.files, n_workers=2)
+        self.assertEqual(expected, self.builder.parser.data)
+        self.assertEqual(
+            'from file 3',
+            self.builder.parser.data['job']['duplicate']['description'])
+
+    def test_parallel_parse_duplicates(self):
+        with ExpectedException(JenkinsJobsException,
+                               "^Duplicate entry found in '.*jobs1.yaml: "):
+            self.builder.load_files(self.files, n_workers=2)
+
+
+class TestCaseTestBuilderDeleteOldManaged(LoggingFixture, TestCase):
+    def setUp(self):
+        super(TestCaseTestBuilderDeleteOldManaged, self).setUp()
+        cache_patch = mock.patch('jenkins_jobs.builder.CacheStorage',
+                                 mock.MagicMock)
+        cache_patch.start()
+        self.addCleanup(cache_patch.stop)
+
+        jobs = {}
+        for n in range(20):
+            description = 'job %d' % n
+            if n % 2:
+                description += MAGIC_MANAGE_STRING
+            jobs['job%02d' % n] = (
+                '<project><description>%s</description></project>'
+                % escape(description))
+        jobs['no-description'] = '<project><description/></project>'
+        self.server = self.useFixture(JenkinsServerFixture(
+            jobs, hide_descriptions=['job00', 'job01', 'job02', 'job03']))
+        self.builder = jenkins_jobs.builder.Builder(
+            self.server.url, 'doesnot', 'matter', plugins_list=[])
+        self.delete_patch = mock.patch.object(self.builder, 'delete_job')
+        self.delete_mock = self.delete_patch.start()
+        self.addCleanup(self.delete_patch.stop)
+
+    def _config_requests(self):
+        return sorted(path for method, path in self.server.requests
+                      if path.endswith('/config.xml'))
+
+    def test_delete_old_managed(self):
+        deleted = self.builder.delete_old_managed(
+            keep=['job18', 'job19'], n_workers=2)
+
+        self.assertEqual(9, deleted)
+        self.assertEqual(
+            ['job%02d' % n for n in range(1, 18, 2)],
+            sorted(c[0][0] for c in self.delete_mock.call_args_list))
+        # only the jobs without a description in the job list are fetched
+        self.assertEqual(['/job/job%02d/config.xml' % n for n in range(4)],
+                         self._config_requests())
+
+    def test_delete_old_managed_without_bulk_descriptions(self):
+        with mock.patch.object(
+                self.builder.jenkins, 'get_job_descriptions',
+                side_effect=jenkins_jobs.builder.jenkins.JenkinsException):
+            deleted = self.builder.delete_old_managed(keep=[], n_workers=4)
+
+        self.assertEqual(10, deleted)
+        self.assertEqual(21, len(self._config_requests()))
+
+
+class TestCaseTestBuilderWorkerPool(TestCase):
+    def setUp(self):
+        super(TestCaseTestBuilderWorkerPool, self).setUp()
+        patcher = mock.patch('jenkins_jobs.builder.CacheStorage')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.builder = jenkins_jobs.builder.Builder(
+            'http://jenkins.example.com', 'doesnot', 'matter',
+            plugins_list=[])
+        self.addCleanup(self.builder.shutdown)
+
+    def test_pool_shared(self):
+        pool = self.builder.get_worker_pool(3)
+        self.assertIs(pool, self.builder.get_worker_pool(3))
+        self.assertEqual(3, pool.n_workers)
+
+        other = self.builder.get_worker_pool(2)
+        self.assertIsNot(pool, other)
+        self.assertEqual(2, other.n_workers)
+
+    def test_update_jobs_reuse_workers(self):
+        path = self.useFixture(fixtures.TempDir()).path
+        jobs_fn = os.path.join(path, 'jobs.yaml')
+        with io.open(jobs_fn, 'w', encoding='utf-8') as f:
+            f.write(u'\n'.join('- job:\n    name: job%02d' % n
+                               for n in range(10)))
+        self.builder.cache.has_changed.return_value = True
+
+        with mock.patch.object(self.builder.jenkins, 'get_jobs'), \
+                mock.patch.object(self.builder.jenkins, 'update_job') \
+                as update_mock, \
+                mock.patch('jenkins_jobs.parallel.Worker.start',
+                           autospec=True,
+                           side_effect=jenkins_jobs.parallel.Worker.start) \
+                as start_mock:
+            self.builder.update_jobs([jobs_fn], n_workers=4)
+            self.builder.update_jobs([jobs_fn], n_workers=4)
+
+        # the same workers checked and uploaded the jobs of both runs
+        self.assertEqual(4, start_mock.call_count)
+        self.assertEqual(2 * 10, update_mock.call_count)
+
+        workers = self.builder.get_worker_pool(4).workers
+        self.builder.shutdown()
+        self.assertFalse(any(worker.is_alive() for worker in workers))
+
+
+class TestCaseTestJenkinsConnections(LoggingFixture, TestCase):
+    def setUp(self):
+        super(TestCaseTestJenkinsConnections, self).setUp()
+        jobs = dict(('job%02d' % n, '<project><description/></project>')
+                    for n in range(40))
+        self.server = self.useFixture(JenkinsServerFixture(
+            jobs, hide_descriptions=jobs, crumb='secret'))
+        self.jenkins = jenkins_jobs.builder.Jenkins(
+            self.server.url, 'doesnot', 'matter')
+
+    def test_connections_reused_by_workers(self):
+        self.jenkins.set_pool_size(12)
+        managed = self.jenkins.get_managed_jobs(
+            sorted(self.server.jobs), n_workers=12)
+
+        self.assertEqual(set(), managed)
+        self.assertEqual(41, len([path for method, path
+                                  in self.server.requests
+                                  if 'crumbIssuer' not in path]))
+        self.assertThat(len(self.server.connections), LessThan(13))
+
+    def test_pool_kept_for_same_size(self):
+        self.jenkins.set_pool_size(4)
+        self.jenkins.get_managed_jobs(sorted(self.server.jobs)[:8],
+                                      n_workers=4)
+        adapters = dict(self.jenkins.jenkins._session.adapters)
+        connections = len(self.server.connections)
+
+        self.jenkins.set_pool_size(4)
+        self.jenkins.get_managed_jobs(sorted(self.server.jobs)[8:],
+                                      n_workers=4)
+        self.assertEqual(adapters, self.jenkins.jenkins._session.adapters)
+        self.assertEqual(connections, len(self.server.connections))
+
+    def test_replaced_pool_closed(self):
+        self.jenkins.set_pool_size(4)
+        adapters = list(self.jenkins.jenkins._session.adapters.values())
+        with mock.patch.object(adapters[0], 'close') as close:
+            self.jenkins.set_pool_size(8)
+        close.assert_called_once_with()
+        self.assertNotIn(adapters[0],
+                         self.jenkins.jenkins._session.adapters.values())
+
+    def test_crumb_fetched_once(self):
+        self.jenkins.get_managed_jobs(sorted(self.server.jobs), n_workers=8)
+
+        self.assertEqual(1, len([path for method, path
+                                 in self.server.requests
+                                 if 'crumbIssuer' in path]))
+
+    def test_request_latency_logged(self):
+        log = self.useFixture(fixtures.FakeLogger(level=logging.DEBUG))
+        self.jenkins.is_managed('job00')
+
+        self.assertThat(
+            log.output,
+            MatchesRegex(r'.*^GET %sjob/job00/config.xml took \d+\.\d{3}s$'
+                         % re.escape(self.server.url), re.M | re.S))
+
+
+class TestCaseTestJenkinsJobsSnapshot(LoggingFixture, TestCase):
+    def setUp(self):
+        super(TestCaseTestJenkinsJobsSnapshot, self).setUp()
+        jobs = dict(('job%02d' % n, '<project/>') for n in range(10))
+        self.server = self.useFixture(JenkinsServerFixture(jobs))
+        self.jenkins = jenkins_jobs.builder.Jenkins(
+            self.server.url, 'doesnot', 'matter')
+
+    def _requests(self, prefix):
+        return [path for method, path in self.server.requests
+                if method == 'GET' and path.startswith(prefix) and
+                path.split('?')[0].endswith('/api/json')]
+
+    def test_update_jobs_from_snapshot(self):
+        self.jenkins.update_job(
+            n_workers=4,
+            parallelize=[{'job_name': 'job%02d' % n, 'xml': '<project/>'}
+                         for n in range(5, 15)])
+
+        # the jobs are fetched once, and the existing jobs are reconfigured
+        # without checking whether they exist
+        self.assertEqual(1, len(self._requests('/api/json')))
+        self.assertEqual([], [path for path in self._requests('/job/')
+                              if int(path[len('/job/job'):][:2]) < 10])
+        self.assertEqual(15, len(self.server.jobs))
+        self.assertEqual(sorted(self.server.jobs), sorted(
+            job['name'] for job in self.jenkins.get_jobs()))
+
+    def test_update_jobs_in_folders(self):
+        client = mock.Mock()
+        client.get_jobs.return_value = [{'name': 'folder'}]
+        client.job_exists.side_effect = lambda name: name == 'folder/old'
+        self.jenkins.jenkins = client
+
+        self.jenkins.update_job('folder/old', '<project/>')
+        self.jenkins.update_job('folder/new', '<project/>')
+
+        # existing jobs in folders are reconfigured after a single check
+        self.assertEqual([mock.call('folder/old'), mock.call('folder/new')],
+                         client.job_exists.call_args_list)
+        client.reconfig_job.assert_called_once_with('folder/old',
+                                                    '<project/>')
+        client.create_job.assert_called_once_with('folder/new', '<project/>')
+        self.assertTrue(self.jenkins.is_job('folder/new'))
+
+    def test_delete_job_updates_snapshot(self):
+        self.assertTrue(self.jenkins.is_job('job00'))
+        self.jenkins.delete_job('job00')
+
+        self.assertFalse(self.jenkins.is_job('job00'))
+        self.assertNotIn('job00', self.server.jobs)
+        self.assertEqual(1, len(self._requests('/api/json')))
+
+    def test_delete_missing_jobs(self):
+        client = mock.Mock()
+        client.get_jobs.return_value = [{'name': 'folder'}]
+        client.job_exists.return_value = False
+        self.jenkins.jenkins = client
+
+        self.jenkins.delete_job('folder/missing')
+        self.jenkins.delete_job('missing')
+
+        # each missing job is looked up in Jenkins a single time
+        self.assertEqual([mock.call('folder/missing'), mock.call('missing')],
+                         client.job_exists.call_args_list)
+        self.assertFalse(client.delete_job.called)
+
+    def test_refresh_snapshot(self):
+        self.assertFalse(self.jenkins.is_job('other'))
+        self.server.jobs['other'] = '<project/>'
+        self.assertFalse(self.jenkins.is_job('other'))
+
+        self.jenkins.get_jobs(cache=False)
+        self.assertTrue(self.jenkins.is_job('other'))
+        self.assertEqual(2, len(self._requests('/api/json')))
+
+
+class TestCaseTestIsOverload(TestCase):
+    def test_timeouts(self):
+        self.assertTrue(jenkins_jobs.builder.is_overload(socket.timeout()))
+        self.assertTrue(jenkins_jobs.builder.is_overload(
+            jenkins_jobs.builder.jenkins.TimeoutException('timed out')))
+
+    def test_server_errors(self):
+        for status, overload in ((502, True), (503, True), (504, True),
+                                 (404, False)):
+            exc = Exception()
+            exc.response = mock.Mock(status_code=status)
+            self.assertEqual(overload, jenkins_jobs.builder.is_overload(exc))
+        # answered by jenkins when rejecting the configuration of a job
+        self.assertFalse(jenkins_jobs.builder.is_overload(
+            jenkins_jobs.builder.jenkins.JenkinsException(
+                'Error in request. Possibly authentication failed [500]: '
+                'Server Error')))
+        self.assertFalse(jenkins_jobs.builder.is_overload(
+            jenkins_jobs.builder.jenkins.JenkinsException(
+                'Error in request. Possibly authentication failed [403]: '
+                'Forbidden')))
+
+    def test_transient_errors(self):
+        for exc in (requests.exceptions.ConnectionError('reset'),
+                    requests.exceptions.ReadTimeout('timed out'),
+                    socket.timeout()):
+            self.assertTrue(jenkins_jobs.builder.is_transient(exc))
+        exc = requests.exceptions.HTTPError(
+            response=mock.Mock(status_code=503))
+        self.assertTrue(jenkins_jobs.builder.is_transient(exc))
+
+    def test_permanent_errors(self):
+        exc = requests.exceptions.HTTPError(
+            response=mock.Mock(status_code=400))
+        self.assertFalse(jenkins_jobs.builder.is_transient(exc))
+        self.assertFalse(jenkins_jobs.builder.is_transient(
+            jenkins_jobs.builder.jenkins.JenkinsException(
+                'Error in request. Possibly authentication failed [500]: '
+                'Server Error')))
+        self.assertFalse(jenkins_jobs.builder.is_transient(
+            IOError(errno.ENOENT, 'No such file or directory')))
+
+    def test_fatal_errors(self):
+        for status, fatal in ((401, True), (403, True), (404, False),
+                              (500, False)):
+            self.assertEqual(fatal, jenkins_jobs.builder.is_fatal(
+                jenkins_jobs.builder.jenkins.JenkinsException(
+                    'Error in request. Possibly authentication failed '
+                    '[%d]: Error' % status)))
+        exc = Exception()
+        exc.response = mock.Mock(status_code=403)
+        self.assertTrue(jenkins_jobs.builder.is_fatal(exc))
+        self.assertFalse(jenkins_jobs.builder.is_fatal(socket.timeout()))
+
+    def test_not_found_errors(self):
+        self.assertTrue(jenkins_jobs.builder.is_not_found(
+            jenkins_jobs.builder.jenkins.NotFoundException(
+                'Requested item could not be found')))
+        self.assertTrue(jenkins_jobs.builder.is_not_found(
+            requests.exceptions.HTTPError(
+                response=mock.Mock(status_code=404))))
+        self.assertFalse(jenkins_jobs.builder.is_not_found(
+            jenkins_jobs.builder.jenkins.JenkinsException(
+                'Error in request. Possibly authentication failed [403]: '
+                'Forbidden')))
+        self.assertFalse(jenkins_jobs.builder.is_not_found(socket.timeout()))
+
+
+class JobsBuilderTestCase(TestCase):
+    """Base of the tests running a Builder on the jobs ``job00``,
+    ``job01``... of a yaml file written in a temporary directory, with the
+    job cache mocked to report every job as changed.
+    """
+    def setUp(self):
+        super(JobsBuilderTestCase, self).setUp()
+        self.log = self.useFixture(fixtures.FakeLogger(level=logging.DEBUG))
+        patcher = mock.patch('jenkins_jobs.builder.CacheStorage')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.url = 'http://jenkins.example.com'
+        self.config = configparser.ConfigParser()
+        self.config.readfp(StringIO(DEFAULT_CONF))
+        self.path = self.useFixture(fixtures.TempDir()).path
+        self.jobs_fn = os.path.join(self.path, 'jobs.yaml')
+
+    def _write_jobs(self, numbers, fields=u''):
+        with io.open(self.jobs_fn, 'w', encoding='utf-8') as f:
+            f.write(u'\n'.join(u'- job:\n    name: job%02d\n' % n + fields
+                               for n in numbers))
+
+    def _builder(self):
+        builder = jenkins_jobs.builder.Builder(
+            self.url, 'doesnot', 'matter', self.config, plugins_list=[])
+        builder.cache.has_changed.return_value = True
+        self.addCleanup(builder.shutdown)
+        return builder
+
+
+class TestCaseTestBuilderRemoteDiff(JobsBuilderTestCase):
+    def setUp(self):
+        super(TestCaseTestBuilderRemoteDiff, self).setUp()
+        self.server = self.useFixture(JenkinsServerFixture())
+        self.url = self.server.url
+        self.config.set('job_builder', 'remote_diff', 'True')
+        self.builder = self._builder()
+
+        self._write_jobs(range(6), u'    description: generated')
+        jobs, _ = self.builder.update_jobs([self.jobs_fn], output=self.path)
+        self.generated = dict((job.name, job) for job in jobs)
+
+        for n in range(4):
+            # stored by jenkins with its own formatting
+            xml = self.generated['job%02d' % n].output().decode('utf-8')
+            self.server.jobs['job%02d' % n] = (
+                u"<?xml version='1.1' encoding='UTF-8'?>" +
+                re.sub(r'>\s+<', '><', xml.split('\n', 1)[1]))
+        self.server.jobs['job03'] = self.server.jobs['job03'].replace(
+            'generated', 'edited')
+
+    def _posted(self):
+        return sorted(path for method, path in self.server.requests
+                      if method == 'POST')
+
+    def test_only_differences_uploaded(self):
+        jobs, num_updated = self.builder.update_jobs([self.jobs_fn],
+                                                     n_workers=4)
+
+        self.assertEqual(['job03', 'job04', 'job05'],
+                         [job.name for job in jobs])
+        self.assertEqual(3, num_updated)
+        self.assertEqual(['/createItem?name=job04', '/createItem?name=job05',
+                          '/job/job03/config.xml'], self._posted())
+        self.assertEqual(
+            [mock.call(name, self.generated[name].md5())
+             for name in ('job00', 'job01', 'job02', 'job03', 'job04',
+                          'job05')],
+            sorted(self.builder.cache.set.call_args_list))
+        # the jobs missing from jenkins are fetched like the others
+        self.assertEqual(6, len([path for method, path
+                                 in self.server.requests
+                                 if path.endswith('/config.xml') and
+                                 method == 'GET']))
+        self.assertNotIn('Unable to compare', self.log.output)
+
+    def test_existence_not_checked(self):
+        jobs = [self.generated['job00'],
+                XmlJob(self.generated['job04'].xml, 'folder/job04')]
+
+        with mock.patch.object(self.builder.jenkins, 'is_job') as is_job_mock:
+            changed = self.builder.filter_remote_changed(jobs, n_workers=2)
+
+        self.assertEqual(['folder/job04'], [job.name for job in changed])
+        self.assertFalse(is_job_mock.called)
+        self.assertEqual(
+            ['/job/folder/job/job04/config.xml', '/job/job00/config.xml'],
+            sorted(path for method, path in self.server.requests
+                   if path.endswith('/config.xml')))
+        self.assertIn("'folder/job04' is missing from jenkins",
+                      self.log.output)
+
+    def test_fetch_failure_uploads(self):
+        self.server.jobs['job01'] = 'not xml'
+
+        jobs, num_updated = self.builder.update_jobs([self.jobs_fn])
+
+        self.assertEqual(['job01', 'job03', 'job04', 'job05'],
+                         [job.name for job in jobs])
+        self.assertThat(self.log.output, MatchesRegex(
+            r'.*Unable to compare jenkins job job01', re.S))
+
+    def test_fetch_failure_single_existing_job(self):
+        for name in ('job00', 'job02', 'job03'):
+            del self.server.jobs[name]
+        self.server.jobs['job01'] = 'not xml'
+
+        jobs, num_updated = self.builder.update_jobs([self.jobs_fn],
+                                                     n_workers=4)
+
+        self.assertEqual(6, num_updated)
+        self.assertIn('/job/job01/config.xml', self._posted())
+        self.assertThat(self.log.output, MatchesRegex(
+            r'.*Unable to compare jenkins job job01', re.S))
+
+    def test_disabled(self):
+        self.builder.global_config.set('job_builder', 'remote_diff', 'False')
+
+        jobs, num_updated = self.builder.update_jobs([self.jobs_fn])
+
+        self.assertEqual(6, num_updated)
+        self.assertEqual([], [path for method, path in self.server.requests
+                              if method == 'GET' and
+                              path.endswith('/config.xml')])
+
+
+class TestCaseTestBuilderScriptUpload(JobsBuilderTestCase):
+    def setUp(self):
+        super(TestCaseTestBuilderScriptUpload, self).setUp()
+        self.server = self.useFixture(JenkinsServerFixture(
+            dict(('job%02d' % n, '<project/>') for n in range(5))))
+        self.url = self.server.url
+        self.config.set('job_builder', 'upload_engine', 'script')
+        self.config.set('job_builder', 'upload_batch_size', '5000')
+        self.builder = self._builder()
+        self._write_jobs(range(20))
+
+    def _scripts(self):
+        return [path for method, path in self.server.requests
+                if path == '/scriptText']
+
+    def test_update_jobs_in_batches(self):
+        jobs, num_updated = self.builder.update_jobs([self.jobs_fn],
+                                                     n_workers=2)
+
+        self.assertEqual(20, num_updated)
+        self.assertEqual(
+            sorted(mock.call(job.name, job.md5()) for job in jobs),
+            sorted(self.builder.cache.set.call_args_list))
+        self.assertEqual(dict((job.name, job.output().decode('utf-8'))
+                              for job in jobs), self.server.jobs)
+        # the jobs are sent in a few scripts instead of one request each
+        self.assertThat(len(self._scripts()), LessThan(10))
+        self.assertEqual(['/scriptText'], sorted(set(
+            path for method, path in self.server.requests
+            if method == 'POST')))
+        self.assertTrue(self.builder.jenkins.is_job('job19'))
+
+    def test_batch_size(self):
+        self.builder.global_config.set('job_builder', 'upload_batch_size',
+                                       '1')
+        self.builder.update_jobs([self.jobs_fn], n_workers=4)
+
+        self.assertEqual(20, len(self._scripts()))
+
+    def test_job_failures(self):
+        results = self.builder.jenkins.update_jobs_by_script(
+            [('job00', '<project><disabled>true</disabled></project>'),
+             ('new', 'not xml'), ('job01', '<project/>')])
+
+        self.assertEqual(None, results[0])
+        self.assertThat(str(results[1]), MatchesRegex(
+            r'Failed to update jenkins job new: syntax error'))
+        self.assertEqual(None, results[2])
+        self.assertNotIn('new', self.server.jobs)
+        self.assertEqual('<project><disabled>true</disabled></project>',
+                         self.server.jobs['job00'])
+
+    def test_missing_status(self):
+        with mock.patch.object(self.builder.jenkins.jenkins, 'run_script',
+                               return_value='jjb-status 1 updated\n'
+                               'java.lang.OutOfMemoryError\n'):
+            results = self.builder.jenkins.update_jobs_by_script(
+                [('job00', '<project/>'), ('job01', '<project/>')])
+
+        self.assertThat(str(results[0]), MatchesRegex(
+            r'No status reported for jenkins job job00, the script output '
+            r'was: jjb-status 1 updated\njava.lang.OutOfMemoryError$'))
+        self.assertEqual(None, results[1])
+
+    def test_batch_failure(self):
+        self.builder.global_config.set('job_builder', 'upload_retries', '0')
+        with mock.patch.object(
+                self.builder.jenkins.jenkins, 'run_script',
+                side_effect=jenkins_jobs.builder.jenkins.JenkinsException(
+                    'Error in request. Possibly authentication failed '
+                    '[403]: Forbidden')):
+            with ExpectedException(
+                    jenkins_jobs.builder.jenkins.JenkinsException,
+                    '.*Forbidden'):
+                self.builder.update_jobs([self.jobs_fn])
+
+        self.assertFalse(self.builder.cache.set.called)
+
+
+class TestCaseTestBuilderPipeline(JobsBuilderTestCase):
+    def setUp(self):
+        super(TestCaseTestBuilderPipeline, self).setUp()
+        self.server = self.useFixture(JenkinsServerFixture(
+            dict(('job%02d' % n, '<project/>') for n in range(5))))
+        self.url = self.server.url
+        self.config.set('job_builder', 'upload_pipeline', 'True')
+        self.config.set('job_builder', 'upload_retries', '0')
+        self.builder = self._builder()
+        self._write_jobs(reversed(range(20)))
+
+    def test_same_as_not_pipelined(self):
+        names, num_updated = self.builder.update_jobs([self.jobs_fn],
+                                                      n_workers=2)
+        cached = sorted(self.builder.cache.set.call_args_list)
+        self.assertEqual([], self.builder.parser.xml_jobs)
+        uploaded = dict(self.server.jobs)
+
+        self.config.set('job_builder', 'upload_pipeline', 'False')
+        expected = self._builder()
+        jobs, num_expected = expected.update_jobs([self.jobs_fn],
+                                                  n_workers=2)
+
+        self.assertEqual(num_expected, num_updated)
+        self.assertEqual([job.name for job in jobs], names)
+        self.assertEqual(self.server.jobs, uploaded)
+        self.assertEqual(
+            sorted(mock.call(job.name, job.md5()) for job in jobs), cached)
+
+    def test_uploads_overlap_generation(self):
+        events = []
+        getXMLForJob = jenkins_jobs.parser.YamlParser.getXMLForJob
+        update_job = jenkins_jobs.builder.Builder.parallel_update_job
+
+        def generate(parser, data):
+            events.append('generate')
+            return getXMLForJob(parser, data)
+
+        def upload(builder, job):
+            events.append('upload')
+            return update_job(builder, job)
+
+        with mock.patch('jenkins_jobs.parser.YamlParser.getXMLForJob',
+                        generate), \
+                mock.patch('jenkins_jobs.builder.Builder.parallel_update_job',
+                           upload):
+            self.builder.update_jobs([self.jobs_fn], n_workers=1)
+
+        self.assertEqual(20, events.count('upload'))
+        self.assertThat(events.index('upload'), LessThan(
+            len(events) - events[::-1].index('generate') - 1))
+
+    def test_generation_bounded_with_workers(self):
+        self.config.set('job_builder', 'upload_queue_depth', '2')
+        self.useFixture(fixtures.MonkeyPatch(
+            __name__ + '._generated_jobs', multiprocessing.Value('i', 0)))
+        lock = threading.Lock()
+        uploaded = []
+        ahead = []
+        update_job = jenkins_jobs.builder.Builder.parallel_update_job
+
+        def upload(builder, job):
+            # leave the workers the time to get ahead of the uploads
+            time.sleep(0.02)
+            with lock:
+                ahead.append(_generated_jobs.value - len(uploaded))
+            result = update_job(builder, job)
+            with lock:
+                uploaded.append(job.name)
+            return result
+
+        with mock.patch('jenkins_jobs.parser._generate_xml',
+                        _count_generated_xml), \
+                mock.patch('jenkins_jobs.builder.Builder.parallel_update_job',
+                           upload):
+            names, num_updated = self.builder.update_jobs([self.jobs_fn],
+                                                          n_workers=2)
+
+        self.assertEqual(20, num_updated)
+        # at most 2 jobs queued for the uploads, and 2 generated ahead
+        self.assertThat(max(ahead), LessThan(5))
+
+    def test_unchanged_jobs_skipped(self):
+        self.builder.cache.has_changed.side_effect = (
+            lambda name, md5: name.endswith('1'))
+
+        names, num_updated = self.builder.update_jobs([self.jobs_fn],
+                                                      n_workers=2)
+
+        self.assertEqual(['job01', 'job11'], names)
+        self.assertEqual(2, num_updated)
+
+    def test_failures_raised(self):
+        with mock.patch.object(
+                self.builder.jenkins.jenkins, 'reconfig_job',
+                side_effect=jenkins_jobs.builder.jenkins.JenkinsException(
+                    'Error in request [400]: Bad Request')):
+            with ExpectedException(
+                    jenkins_jobs.builder.jenkins.JenkinsException,
+                    '.*Bad Request'):
+                self.builder.update_jobs([self.jobs_fn], n_workers=2)
+
+        self.assertIn('Failed to update 5 of 20 jobs', self.log.output)
+        # the jobs created are still recorded in the cache
+        self.assertEqual(15, self.builder.cache.set.call_count)
+        self.assertTrue(self.builder.cache.save.called)
+
+    def test_not_pipelined_with_remote_diff(self):
+        self.config.set('job_builder', 'remote_diff', 'True')
+
+        jobs, num_updated = self.builder.update_jobs([self.jobs_fn],
+                                                     n_workers=2)
+
+        self.assertEqual(20, num_updated)
+        self.assertIn('Not pipelining the uploads', self.log.output)
+        self.assertEqual(20, len(self.builder.parser.xml_jobs))
+
+
+class TestCaseTestBuilderStreamOutput(JobsBuilderTestCase):
+    def setUp(self):
+        super(TestCaseTestBuilderStreamOutput, self).setUp()
+        self.config.set('job_builder', 'stream_output', 'True')
+        self.builder = self._builder()
+        self._write_jobs(reversed(range(10)))
+
+    def _written(self, output):
+        return dict((name, io.open(os.path.join(output, name), 'rb').read())
+                    for name in os.listdir(output))
+
+    def test_same_as_not_streamed(self):
+        streamed = os.path.join(self.path, 'streamed')
+        names, num_jobs = self.builder.update_jobs([self.jobs_fn],
+                                                   output=streamed)
+        self.config.set('job_builder', 'stream_output', 'False')
+        expected = os.path.join(self.path, 'expected')
+        jobs, num_expected = self._builder().update_jobs([self.jobs_fn],
+                                                         output=expected)
+
+        self.assertEqual(num_expected, num_jobs)
+        self.assertEqual([job.name for job in jobs], names)
+        self.assertEqual(self._written(expected), self._written(streamed))
+        self.assertEqual([], self.builder.parser.xml_jobs)
+
+    def test_stream_sorted(self):
+        output = io.BytesIO()
+        self.builder.update_jobs([self.jobs_fn], output=output)
+
+        self.assertEqual(
+            ['job%02d' % n for n in range(10)],
+            re.findall(r'Job name:  (job\d+)', self.log.output))
+        self.assertEqual(10, output.getvalue().count(b'<?xml'))
+
+    def test_jobs_written_as_generated(self):
+        events = []
+        getXMLForJob = jenkins_jobs.parser.YamlParser.getXMLForJob
+        write = jenkins_jobs.xml_config.XmlJob.output
+
+        def generate(parser, data):
+            events.append('generate')
+            return getXMLForJob(parser, data)
+
+        def output(job):
+            events.append('write')
+            return write(job)
+
+        with mock.patch('jenkins_jobs.parser.YamlParser.getXMLForJob',
+                        generate), \
+                mock.patch('jenkins_jobs.xml_config.XmlJob.output', output):
+            self.builder.update_jobs([self.jobs_fn],
+                                     output=os.path.join(self.path, 'out'))
+
+        # each job is written before the next one is generated
+        self.assertEqual(['generate', 'write'] * 10, events)
@@ -13,8 +13,15 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import io
 import os
+import threading
+import time
+
+import fixtures
 import testtools
+from testtools.content import text_content
+import yaml
 
 import jenkins_jobs
 from tests.base import LoggingFixture
@@ -43,5 +50,123 @@ class TestCaseCacheStorage(LoggingFixture, testtools.TestCase):
         """
         test_file = os.path.abspath(__file__)
         with mock.patch('os.path.join', return_value=test_file):
-            with mock.patch('yaml.load'):
+            with mock.patch('json.loads'):
                 jenkins_jobs.builder.CacheStorage("dummy").data = None
+
+
+class TestCaseCacheStorageFiles(LoggingFixture, testtools.TestCase):
+
+    def setUp(self):
+        super(TestCaseCacheStorageFiles, self).setUp()
+        self.cache_dir = self.useFixture(fixtures.TempDir()).path
+        cache_dir_patch = mock.patch(
+            'jenkins_jobs.builder.CacheStorage.get_cache_dir',
+            return_value=self.cache_dir)
+        cache_dir_patch.start()
+        self.addCleanup(cache_dir_patch.stop)
+
+    def _create(self, flush=False):
+        cache = jenkins_jobs.builder.CacheStorage('http://jenkins.example.com',
+                                                  flush=flush)
+        self.addCleanup(setattr, cache, 'data', None)
+        return cache
+
+    def test_save_and_load(self):
+        cache = self._create()
+        cache.set('job1', 'md5-1')
+        cache.set(u'job-\u00e9', 'md5-2')
+        cache.save()
+
+        cache = self._create()
+        self.assertFalse(cache.has_changed('job1', 'md5-1'))
+        self.assertFalse(cache.has_changed(u'job-\u00e9', 'md5-2'))
+        self.assertTrue(cache.has_changed('job2', 'md5-1'))
+        self.assertTrue(cache.cachefilename.endswith('.json'))
+
+    def test_migrate_yaml_cache(self):
+        yaml_cachefilename = os.path.join(
+            self.cache_dir, 'cache-host-jobs-http___jenkins_example_com.yml')
+        with io.open(yaml_cachefilename, 'w', encoding='utf-8') as yfile:
+            yaml.dump({'job1': 'md5-1', 'job2': 'md5-2'}, yfile)
+
+        cache = self._create()
+        self.assertEqual({'job1': 'md5-1', 'job2': 'md5-2'}, cache.data)
+        cache.set('job2', 'md5-3')
+        cache.save()
+
+        # the json cache now takes precedence over the yaml one
+        self.assertEqual({'job1': 'md5-1', 'job2': 'md5-3'},
+                         self._create().data)
+        self.assertEqual({}, self._create(flush=True).data)
+
+    def test_benchmark(self):
+        """
+        Benchmark saving and loading a cache of 100k jobs
+        """
+        cache = self._create()
+        for n in range(100000):
+            cache.set('job-%06d' % n, '%032x' % n)
+
+        start = time.time()
+        cache.save()
+        saved = time.time()
+        cache = self._create()
+        loaded = time.time()
+        self.addDetail('save-time', text_content('%.3fs' % (saved - start)))
+        self.addDetail('load-time', text_content('%.3fs' % (loaded - saved)))
+
+        self.assertEqual(100000, len(cache.data))
+        self.assertEqual('%032x' % 99999, cache.data['job-099999'])
+
+    def test_save_merges_concurrent_runs(self):
+        caches = [self._create() for _ in range(8)]
+        for n, cache in enumerate(caches):
+            for m in range(25):
+                cache.set('job-%d-%d' % (n, m), 'md5')
+
+        threads = [threading.Thread(target=cache.save) for cache in caches]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(200, len(self._create().data))
+        self.assertEqual([], [f for f in os.listdir(self.cache_dir)
+                              if not f.endswith(('.json', '.lock'))])
+
+    def test_save_skipped_when_unchanged(self):
+        cache = self._create()
+        cache.set('job1', 'md5-1')
+        cache.save()
+
+        cache = self._create()
+        cache.set('job1', 'md5-1')
+        with mock.patch.object(cache, '_write') as write_mock:
+            cache.save()
+        self.assertFalse(write_mock.called)
+
+    def test_clear_discards_saved_entries(self):
+        cache = self._create()
+        cache.set('job1', 'md5-1')
+        cache.save()
+
+        other = self._create()
+        other.set('job2', 'md5-2')
+        cache.clear()
+        cache.set('job3', 'md5-3')
+        other.save()
+        cache.save()
+        self.assertEqual({'job3': 'md5-3'}, self._create().data)
+
+    def test_save_failure_keeps_cache(self):
+        cache = self._create()
+        cache.set('job1', 'md5-1')
+        cache.save()
+
+        cache.set('job2', 'md5-2')
+        with mock.patch('json.dumps', side_effect=ValueError('dump')):
+            cache.save()
+        self.assertEqual({'job1': 'md5-1'}, self._create().data)
+        self.assertEqual(['cache-host-jobs-http___jenkins_example_com.json',
+                          'cache-host-jobs-http___jenkins_example_com.json'
+                          '.lock'], sorted(os.listdir(self.cache_dir)))
@@ -203,6 +203,22 @@ class TestTests(CmdTestsBase):
                               'r', encoding='utf-8').read()
         self.assertEqual(console_out.getvalue().decode('utf-8'), xml_content)
 
+    def test_console_output_streamed(self):
+        """
+        Run test mode writing each job as it is generated and verify that
+        the XML is the same as when generating all of them first.
+        """
+        path = os.path.join(self.fixtures_path, 'cmd-002.yaml')
+        outputs = []
+        for args in (['test', path], ['test', '--stream', path]):
+            console_out = io.BytesIO()
+            with mock.patch('sys.stdout', console_out):
+                cmd.main(args)
+            outputs.append(console_out.getvalue())
+
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual(4, outputs[1].count(b'<?xml'))
+
     def test_stream_input_output_utf8_encoding(self):
         """
         Run test mode simulating using pipes for input and output using
@@ -15,10 +15,15 @@
 # under the License.
 
 import os
+import threading
+
+import jenkins
+import requests
 import six
 
 from jenkins_jobs import builder
 from jenkins_jobs import cmd
+from jenkins_jobs.errors import JenkinsJobsException
 from tests.base import mock
 from tests.cmd.test_cmd import CmdTestsBase
 
@@ -60,12 +65,244 @@ class UpdateTests(CmdTestsBase):
         self.assertTrue(isinstance(update_job_mock.call_args[0][1],
                                    six.text_type))
 
+    @mock.patch('jenkins_jobs.builder.Jenkins.get_jobs')
+    @mock.patch('jenkins_jobs.builder.Jenkins.update_job')
+    @mock.patch('jenkins_jobs.builder.run_adaptive',
+                wraps=builder.run_adaptive)
+    def test_update_jobs_adaptive(self, run_mock, update_job_mock,
+                                  get_jobs_mock):
+        """
+        Test the jobs are uploaded from the adaptive engine when selected,
+        with the requests per second capped as requested
+        """
+        path = os.path.join(self.fixtures_path, 'cmd-002.yaml')
+        args = self.parser.parse_args(['update', '--upload-engine',
+                                       'adaptive', '--max-rps', '100', path])
+
+        cmd.execute(args, self.config)
+        self.assertEqual(1, run_mock.call_count)
+        self.assertEqual((100, 2.0, 100.0), run_mock.call_args[0][2:])
+        self.assertEqual(4, update_job_mock.call_count)
+
+    @mock.patch('jenkins_jobs.parallel.time.sleep')
+    @mock.patch('jenkins_jobs.builder.time.sleep')
+    @mock.patch('jenkins_jobs.builder.Jenkins.get_jobs')
+    @mock.patch('jenkins_jobs.builder.Jenkins.update_job')
+    def test_update_jobs_adaptive_retries(self, update_job_mock,
+                                          get_jobs_mock, sleep_mock,
+                                          engine_sleep_mock):
+        """
+        Test the adaptive engine retries the uploads itself
+        """
+        failures = [jenkins.JenkinsException('Error in request. Possibly '
+                                             'authentication failed [503]')]
+
+        def _update_job(name, xml):
+            if failures:
+                raise failures.pop(0)
+        update_job_mock.side_effect = _update_job
+
+        path = os.path.join(self.fixtures_path, 'cmd-002.yaml')
+        args = self.parser.parse_args(['update', '--upload-engine',
+                                       'adaptive', path])
+
+        cmd.execute(args, self.config)
+        self.assertEqual(5, update_job_mock.call_count)
+        self.assertEqual(0, sleep_mock.call_count)
+        self.assertEqual(1, engine_sleep_mock.call_count)
+        self.assertEqual(4, self.cache_mock.return_value.set.call_count)
+
+    @mock.patch('jenkins_jobs.builder.Jenkins.get_jobs')
+    @mock.patch('jenkins_jobs.builder.Jenkins.update_job')
+    @mock.patch('jenkins_jobs.builder.Jenkins.update_jobs_by_script')
+    def test_update_jobs_script(self, update_script_mock, update_job_mock,
+                                get_jobs_mock):
+        """
+        Test the jobs are uploaded in a single script when selected, and the
+        results cached as with the other engines
+        """
+        update_script_mock.side_effect = lambda jobs: [None] * len(jobs)
+
+        path = os.path.join(self.fixtures_path, 'cmd-002.yaml')
+        args = self.parser.parse_args(['update', '--upload-engine', 'script',
+                                       path])
+
+        cmd.execute(args, self.config)
+        self.assertEqual(1, update_script_mock.call_count)
+        self.assertEqual(0, update_job_mock.call_count)
+        uploaded = [name for name, xml in update_script_mock.call_args[0][0]]
+        self.assertEqual(4, len(uploaded))
+        cached = [c[0][0]
+                  for c in self.cache_mock.return_value.set.call_args_list]
+        self.assertEqual(uploaded, cached)
+
+    @mock.patch('jenkins_jobs.builder.time.sleep')
+    @mock.patch('jenkins_jobs.builder.Jenkins.get_jobs')
+    @mock.patch('jenkins_jobs.builder.Jenkins.update_job')
+    def test_update_jobs_retry_transient_failures(self, update_job_mock,
+                                                  get_jobs_mock, sleep_mock):
+        """
+        Test uploads failing with a server error are retried after a delay
+        """
+        failures = [jenkins.JenkinsException('Error in request. Possibly '
+                                             'authentication failed [502]'),
+                    requests.exceptions.ConnectionError(
+                        'Connection reset by peer')]
+
+        def _update_job(name, xml):
+            if failures:
+                raise failures.pop(0)
+        update_job_mock.side_effect = _update_job
+
+        path = os.path.join(self.fixtures_path, 'cmd-002.yaml')
+        args = self.parser.parse_args(['update', path])
+
+        cmd.execute(args, self.config)
+        self.assertEqual(6, update_job_mock.call_count)
+        self.assertEqual(2, sleep_mock.call_count)
+        first_delay, second_delay = [c[0][0]
+                                     for c in sleep_mock.call_args_list]
+        self.assertTrue(0.5 <= first_delay <= 1.5)
+        self.assertTrue(1 <= second_delay <= 3)
+        self.assertEqual(4, self.cache_mock.return_value.set.call_count)
+
+    @mock.patch('jenkins_jobs.builder.time.sleep')
+    @mock.patch('jenkins_jobs.builder.Jenkins.get_jobs')
+    @mock.patch('jenkins_jobs.builder.Jenkins.update_job')
+    def test_update_jobs_permanent_failures_not_retried(self, update_job_mock,
+                                                        get_jobs_mock,
+                                                        sleep_mock):
+        """
+        Test uploads rejected by Jenkins are not retried
+        """
+        bad_request = requests.exceptions.HTTPError(
+            '400 Client Error', response=mock.Mock(status_code=400))
+        invalid_config = jenkins.JenkinsException(
+            'Error in request. Possibly authentication failed [500]: '
+            'Server Error')
+        path = os.path.join(self.fixtures_path, 'cmd-002.yaml')
+
+        for exc in (bad_request, invalid_config):
+            args = self.parser.parse_args(['update', path])
+            update_job_mock.reset_mock()
+            update_job_mock.side_effect = exc
+            self.assertRaises(type(exc), cmd.execute, args, self.config)
+            self.assertEqual(4, update_job_mock.call_count)
+        self.assertEqual(0, sleep_mock.call_count)
+
+    @mock.patch('jenkins_jobs.builder.time.sleep')
+    @mock.patch('jenkins_jobs.builder.Jenkins.get_jobs')
+    @mock.patch('jenkins_jobs.builder.Jenkins.update_job')
+    def test_update_jobs_cache_saved_on_failure(self, update_job_mock,
+                                                get_jobs_mock, sleep_mock):
+        """
+        Test the jobs uploaded are cached even when others fail, and that
+        failures other than server errors are not retried
+        """
+        failed = []
+        lock = threading.Lock()
+
+        def _update_job(name, xml):
+            with lock:
+                if failed and failed != [name]:
+                    return
+                failed[:] = [name]
+            raise jenkins.JenkinsException(
+                'Error in request. Possibly authentication failed [400]')
+        update_job_mock.side_effect = _update_job
+
+        path = os.path.join(self.fixtures_path, 'cmd-002.yaml')
+        args = self.parser.parse_args(['update', '--workers', '2', path])
+
+        self.assertRaises(jenkins.JenkinsException, cmd.execute, args,
+                          self.config)
+        self.assertEqual(4, update_job_mock.call_count)
+        self.assertEqual(0, sleep_mock.call_count)
+        cached = [c[0][0]
+                  for c in self.cache_mock.return_value.set.call_args_list]
+        self.assertEqual(3, len(cached))
+        self.assertNotIn(failed[0], cached)
+        self.assertEqual(1, self.cache_mock.return_value.save.call_count)
+
+    @mock.patch('jenkins_jobs.builder.Jenkins.get_jobs')
+    @mock.patch('jenkins_jobs.builder.Jenkins.update_job')
+    def test_update_jobs_stop_on_authentication_failure(self,
+                                                        update_job_mock,
+                                                        get_jobs_mock):
+        """
+        Test the remaining uploads are cancelled after an authentication
+        failure, which the other jobs would fail with too
+        """
+        update_job_mock.side_effect = jenkins.JenkinsException(
+            'Error in request. Possibly authentication failed [401]: '
+            'Unauthorized')
+
+        path = os.path.join(self.fixtures_path, 'cmd-002.yaml')
+        args = self.parser.parse_args(['update', path])
+
+        self.assertRaises(jenkins.JenkinsException, cmd.execute, args,
+                          self.config)
+        self.assertEqual(1, update_job_mock.call_count)
+        self.assertEqual(0, self.cache_mock.return_value.set.call_count)
+        self.assertEqual(1, self.cache_mock.return_value.save.call_count)
+
+    @mock.patch('jenkins_jobs.builder.Jenkins.get_jobs')
+    @mock.patch('jenkins_jobs.builder.Jenkins.update_job')
+    def test_update_jobs_fail_fast(self, update_job_mock, get_jobs_mock):
+        """
+        Test the remaining uploads are cancelled after any failure when
+        asked to, keeping the jobs uploaded before in the cache
+        """
+        def _update_job(name, xml):
+            if update_job_mock.call_count == 2:
+                raise jenkins.JenkinsException(
+                    'Error in request. Possibly authentication failed [400]')
+        update_job_mock.side_effect = _update_job
+
+        path = os.path.join(self.fixtures_path, 'cmd-002.yaml')
+        args = self.parser.parse_args(['update', '--fail-fast', path])
+
+        self.assertRaises(jenkins.JenkinsException, cmd.execute, args,
+                          self.config)
+        self.assertEqual(2, update_job_mock.call_count)
+        cached = [c[0][0]
+                  for c in self.cache_mock.return_value.set.call_args_list]
+        self.assertEqual([update_job_mock.call_args_list[0][0][0]], cached)
+        self.assertEqual(1, self.cache_mock.return_value.save.call_count)
+
+    @mock.patch('jenkins_jobs.builder.Jenkins.get_jobs')
+    @mock.patch('jenkins_jobs.builder.Jenkins.update_job')
+    def test_update_jobs_pipeline(self, update_job_mock, get_jobs_mock):
+        """
+        Test the jobs are all uploaded when uploaded as they are generated
+        """
+        path = os.path.join(self.fixtures_path, 'cmd-002.yaml')
+        args = self.parser.parse_args(['update', '--pipeline', path])
+
+        cmd.execute(args, self.config)
+        self.assertEqual(['bam001', 'bar001', 'bar002', 'baz001'],
+                         sorted(c[0][0]
+                                for c in update_job_mock.call_args_list))
+        self.assertEqual(1, self.cache_mock.return_value.save.call_count)
+
+    def test_update_jobs_adaptive_invalid_concurrency(self):
+        path = os.path.join(self.fixtures_path, 'cmd-002.yaml')
+        args = self.parser.parse_args(['update', '--upload-engine',
+                                       'adaptive', '--concurrency', '0',
+                                       path])
+
+        self.assertRaises(JenkinsJobsException, cmd.execute, args,
+                          self.config)
+
     @mock.patch('jenkins_jobs.builder.Jenkins.is_job', return_value=True)
+    @mock.patch('jenkins_jobs.builder.Jenkins.get_job_descriptions',
+                return_value={})
     @mock.patch('jenkins_jobs.builder.Jenkins.get_jobs')
     @mock.patch('jenkins_jobs.builder.Builder.delete_job')
     @mock.patch('jenkins_jobs.cmd.Builder')
     def test_update_jobs_and_delete_old(self, builder_mock, delete_job_mock,
-                                        get_jobs_mock, is_job_mock):
+                                        get_jobs_mock, get_descriptions_mock,
+                                        is_job_mock):
         """
         Test update behaviour with --delete-old option
 
@@ -91,7 +328,7 @@ class UpdateTests(CmdTestsBase):
         b_inst.update_jobs.side_effect = builder_obj.update_jobs
         b_inst.delete_old_managed.side_effect = builder_obj.delete_old_managed
 
-        def _get_jobs():
+        def _get_jobs(cache=True):
             return builder_obj.parser.jobs + extra_jobs
         get_jobs_mock.side_effect = _get_jobs
 
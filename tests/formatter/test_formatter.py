@@ -0,0 +1,94 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from string import Formatter
+
+from testtools import ExpectedException
+from testtools import TestCase
+
+from jenkins_jobs.errors import JenkinsJobsException
+from jenkins_jobs.formatter import CustomFormatter
+from jenkins_jobs.formatter import deep_format
+from jenkins_jobs.formatter import LazyFormatDict
+from tests.base import LoggingFixture
+from tests.base import mock
+
+
+class TestCaseDeepFormat(LoggingFixture, TestCase):
+
+    params = {'name': 'foo', 'num': 5, 'width': 3, 'items': ['a', 'b'],
+              'nested': {'key': 'value'}}
+
+    def test_same_as_formatter(self):
+        for fmt in ['plain', '{name}-{num}', '{{escaped}} {name}',
+                    '{num:>4}', '{name!r}', '{items[1]}',
+                    '{nested[key]}', '{num:03}', '{num:>{width}}']:
+            self.assertEqual(CustomFormatter().format(fmt, **self.params),
+                             deep_format(fmt, self.params))
+
+    def test_nested_structures(self):
+        obj = {'{name}-key': ['{num}', {'inner': '{name}'}], 'int': 3}
+        self.assertEqual(
+            {'foo-key': ['5', {'inner': 'foo'}], 'int': 3},
+            deep_format(obj, self.params))
+
+    def test_obj_reference(self):
+        self.assertEqual(['a', 'b'], deep_format('{obj:items}', self.params))
+
+    def test_missing_key(self):
+        with ExpectedException(JenkinsJobsException,
+                               "^missing parameter missing to format "
+                               "{missing}-{name}\nGiven:\n"):
+            deep_format('{missing}-{name}', self.params)
+
+    def test_missing_dict_key(self):
+        with ExpectedException(JenkinsJobsException,
+                               "^missing parameter missing to format "):
+            deep_format({'{missing}': 'value'}, self.params)
+
+    def test_allow_empty(self):
+        self.assertEqual('-foo',
+                         deep_format('{missing}-{name}', self.params, True))
+        self.assertEqual('-foo',
+                         deep_format('{missing!s}-{name}', self.params, True))
+
+    def test_template_compiled_once(self):
+        with mock.patch.object(Formatter, 'parse', autospec=True,
+                               side_effect=Formatter.parse) as parse_mock:
+            for _ in range(3):
+                deep_format('compiled-once-{name}', self.params)
+        self.assertEqual(1, parse_mock.call_count)
+
+
+class TestCaseLazyFormatDict(LoggingFixture, TestCase):
+
+    params = {'name': 'foo', 'ref': '{name}-bar', 'list': ['{name}'],
+              'broken': '{missing}'}
+
+    def test_same_as_deep_format(self):
+        expected = deep_format(dict(self.params, broken=''), self.params)
+        lazy = LazyFormatDict(self.params)
+        for key in ['name', 'ref', 'list']:
+            self.assertEqual(expected[key], lazy[key])
+        self.assertEqual(['{name}'], self.params['list'])
+
+    def test_only_formats_used_values(self):
+        lazy = LazyFormatDict(self.params)
+        self.assertEqual('foo-bar', deep_format('{ref}', lazy))
+        with ExpectedException(JenkinsJobsException,
+                               "^missing parameter missing to format "):
+            deep_format('{broken}', lazy)
+
+    def test_set_values_not_formatted(self):
+        lazy = LazyFormatDict(self.params)
+        lazy['extra'] = '{name}'
+        self.assertEqual('{name}', lazy['extra'])
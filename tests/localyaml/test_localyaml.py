@@ -14,17 +14,22 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import io
 import os
 
+import fixtures
 from testscenarios.testcase import TestWithScenarios
 from testtools import ExpectedException
 from testtools import TestCase
+import yaml
 from yaml.composer import ComposerError
 
 from jenkins_jobs import builder
+from jenkins_jobs import local_yaml
 from tests.base import get_scenarios
 from tests.base import JsonTestCase
 from tests.base import LoggingFixture
+from tests.base import mock
 from tests.base import YamlTestCase
 
 
@@ -79,3 +84,105 @@ class TestCaseLocalYamlIncludeAnchors(LoggingFixture, TestCase):
         b = builder.Builder("http://example.com", "jenkins", None,
                             plugins_list=[])
         b.load_files([os.path.join(self.fixtures_path, f) for f in files])
+
+
+class TestCaseLocalYamlCLoader(TestWithScenarios, LoggingFixture, TestCase):
+    """
+    Verify the libyaml based loader returns exactly the same data as the pure
+    python loader for every yaml fixture in the tests
+    """
+    tests_path = os.path.dirname(os.path.dirname(__file__))
+    scenarios = (get_scenarios(tests_path, 'yaml') +
+                 get_scenarios(tests_path, 'iyaml'))
+
+    def _load(self, loader):
+        local_yaml.LocalAnchorLoader.reset_anchors()
+        with io.open(self.in_filename, 'r', encoding='utf-8') as f:
+            try:
+                return yaml.load(f, loader)
+            except yaml.YAMLError as e:
+                return type(e)
+
+    def test_yaml_parity(self):
+        if local_yaml.CParser is None:
+            self.skipTest("PyYAML built without libyaml support")
+
+        expected = self._load(local_yaml.LocalLoader)
+        self.assertEqual(expected, self._load(local_yaml.LocalCLoader))
+
+
+class TestCaseYamlCache(LoggingFixture, TestCase):
+
+    def setUp(self):
+        super(TestCaseYamlCache, self).setUp()
+        self.tmpdir = self.useFixture(fixtures.TempDir()).path
+        self.cache = local_yaml.YamlCache(os.path.join(self.tmpdir, 'cache'))
+        self.yaml_fn = os.path.join(self.tmpdir, 'jobs.yaml')
+        self._write(self.yaml_fn,
+                    u"- job:\n    name: foo\n"
+                    u"    builders:\n"
+                    u"      - shell: !include-raw: script.sh\n")
+        self._write(os.path.join(self.tmpdir, 'script.sh'), u"echo one\n")
+
+    def _write(self, fn, content):
+        with io.open(fn, 'w', encoding='utf-8') as f:
+            f.write(content)
+
+    def _load(self, search_path=None):
+        with mock.patch('jenkins_jobs.local_yaml.load',
+                        wraps=local_yaml.load) as load_mock:
+            data = self.cache.load(self.yaml_fn, search_path)
+        return data, load_mock.called
+
+    def _chdir(self, path):
+        cwd = os.getcwd()
+        os.chdir(path)
+        self.addCleanup(os.chdir, cwd)
+
+    def test_unchanged_files_use_cache(self):
+        data, parsed = self._load()
+        self.assertTrue(parsed)
+        cached_data, parsed = self._load()
+        self.assertFalse(parsed)
+        self.assertEqual(data, cached_data)
+
+    def test_changed_include_invalidates_cache(self):
+        self._load()
+        self._write(os.path.join(self.tmpdir, 'script.sh'), u"echo two\n")
+        data, parsed = self._load()
+        self.assertTrue(parsed)
+        self.assertEqual(u"echo two\n",
+                         data[0]['job']['builders'][0]['shell'])
+
+    def test_include_earlier_in_search_path_invalidates_cache(self):
+        include_dir = os.path.join(self.tmpdir, 'include')
+        os.mkdir(include_dir)
+        self._load([include_dir])
+        self._write(os.path.join(include_dir, 'script.sh'), u"echo two\n")
+        data, parsed = self._load([include_dir])
+        self.assertTrue(parsed)
+        self.assertEqual(u"echo two\n",
+                         data[0]['job']['builders'][0]['shell'])
+
+    def test_include_from_other_directory(self):
+        self._write(self.yaml_fn,
+                    u"- job:\n    name: foo\n"
+                    u"    builders:\n"
+                    u"      - shell: !include-raw: local.sh\n")
+        scripts = []
+        for name in ('one', 'two'):
+            path = os.path.join(self.tmpdir, name)
+            os.mkdir(path)
+            self._write(os.path.join(path, 'local.sh'), u"echo %s\n" % name)
+            self._chdir(path)
+            data, parsed = self._load()
+            self.assertTrue(parsed)
+            scripts.append(data[0]['job']['builders'][0]['shell'])
+        self.assertEqual([u"echo one\n", u"echo two\n"], scripts)
+
+    def test_changed_file_invalidates_cache(self):
+        self._load()
+        self._write(self.yaml_fn, u"- job:\n    name: bar\n")
+        data, parsed = self._load()
+        self.assertTrue(parsed)
+        self.assertEqual(u"bar", data[0]['job']['name'])
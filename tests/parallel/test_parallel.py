@@ -12,13 +12,21 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import logging
+import threading
 import time
 from multiprocessing import cpu_count
 
+import fixtures
 from testtools import matchers
 from testtools import TestCase
 
+from jenkins_jobs.parallel import AdaptiveLimiter
 from jenkins_jobs.parallel import parallelize
+from jenkins_jobs.parallel import run_adaptive
+from jenkins_jobs.parallel import TaskCancelled
+from jenkins_jobs.parallel import WorkerPool
+from tests.base import LoggingFixture
 from tests.base import mock
 
 
@@ -68,3 +76,330 @@ class TestCaseParallel(TestCase):
                                n_workers=0)
         self.assertThat(result, matchers.Equals([True for _ in range(10)]))
         mockCpu_count.assert_called_once_with()
+
+
+class TestCaseWorkerPool(TestCase):
+    def setUp(self):
+        super(TestCaseWorkerPool, self).setUp()
+        self.pool = WorkerPool(4)
+        self.addCleanup(self.pool.shutdown)
+
+        @parallelize
+        def current_thread(num):
+            time.sleep(0.01)
+            return num, threading.current_thread()
+        self.current_thread = current_thread
+
+    def test_workers_reused(self):
+        threads = set()
+        for _ in range(5):
+            results = self.current_thread(
+                parallelize=[{'num': num} for num in range(10)],
+                pool=self.pool)
+            self.assertEqual(list(range(10)), [num for num, _ in results])
+            threads.update(thread for _, thread in results)
+
+        self.assertEqual(set(self.pool.workers), threads)
+        self.assertEqual(4, len(threads))
+
+    def test_single_item_run_inline(self):
+        num, thread = self.current_thread(parallelize=[{'num': 1}],
+                                          pool=self.pool)
+
+        self.assertIs(threading.current_thread(), thread)
+        self.assertEqual([], self.pool.workers)
+
+    def test_concurrent_calls(self):
+        results = {}
+
+        def run(base):
+            results[base] = [num for num, _ in self.current_thread(
+                parallelize=[{'num': base + num} for num in range(20)],
+                pool=self.pool)]
+
+        callers = [threading.Thread(target=run, args=(base,))
+                   for base in (0, 100, 200)]
+        for caller in callers:
+            caller.start()
+        for caller in callers:
+            caller.join()
+
+        for base in (0, 100, 200):
+            self.assertEqual(list(range(base, base + 20)), results[base])
+
+    def test_exceptions_in_place(self):
+        @parallelize
+        def fail_odd(num):
+            if num % 2:
+                raise ValueError(num)
+            return num
+
+        with mock.patch('traceback.print_exc'):
+            results = fail_odd(parallelize=[{'num': num} for num in range(6)],
+                               pool=self.pool)
+
+        self.assertEqual([0, 2, 4], results[::2])
+        self.assertEqual([(1,), (3,), (5,)],
+                         [exc.args for exc in results[1::2]])
+
+    def test_shutdown(self):
+        self.current_thread(parallelize=[{'num': num} for num in range(8)],
+                            pool=self.pool)
+        workers = list(self.pool.workers)
+        self.pool.shutdown()
+
+        self.assertEqual([], self.pool.workers)
+        self.assertFalse(any(worker.is_alive() for worker in workers))
+        # the pool starts new workers when used again
+        self.assertEqual(
+            [0, 1], [num for num, _ in self.current_thread(
+                parallelize=[{'num': 0}, {'num': 1}], pool=self.pool)])
+
+
+class TestCaseParallelStream(TestCase):
+    def setUp(self):
+        super(TestCaseParallelStream, self).setUp()
+        self.useFixture(fixtures.MonkeyPatch('traceback.print_exc',
+                                             lambda: None))
+        self.pool = WorkerPool(1)
+        self.addCleanup(self.pool.shutdown)
+        self.ran = []
+
+        @parallelize
+        def run(num, secs=0, exc=None):
+            self.ran.append(num)
+            time.sleep(secs)
+            if exc is not None:
+                raise exc
+            return num
+        self.run_task = run
+
+    def test_results_yielded_when_ready(self):
+        results = self.run_task(
+            parallelize=[{'num': 0}, {'num': 1, 'secs': 1}],
+            n_workers=2, stream=True)
+
+        before = time.time()
+        self.assertEqual(0, next(results))
+        self.assertThat(time.time() - before, matchers.LessThan(0.5))
+        self.assertEqual([1], list(results))
+
+    def test_results_in_order(self):
+        results = self.run_task(
+            parallelize=[{'num': num, 'secs': 0.01 * (10 - num)}
+                         for num in range(10)],
+            n_workers=10, stream=True)
+
+        self.assertEqual(list(range(10)), list(results))
+
+    def test_single_item(self):
+        results = self.run_task(parallelize=[{'num': 3}], stream=True)
+
+        self.assertEqual([3], list(results))
+
+    def test_fail_fast(self):
+        params = [{'num': num} for num in range(10)]
+        params[2]['exc'] = ValueError('failed')
+        results = list(self.run_task(parallelize=params, pool=self.pool,
+                                     stream=True, fail_fast=True))
+
+        self.assertEqual([0, 1], results[:2])
+        self.assertIsInstance(results[2], ValueError)
+        self.assertEqual(7, len(results[3:]))
+        for result in results[3:]:
+            self.assertIsInstance(result, TaskCancelled)
+        self.assertEqual([0, 1, 2], self.ran)
+
+    def test_fail_fast_function(self):
+        params = [{'num': num} for num in range(6)]
+        params[1]['exc'] = TypeError('ignored')
+        params[3]['exc'] = ValueError('fatal')
+        results = self.run_task(
+            parallelize=params, pool=self.pool,
+            fail_fast=lambda exc: isinstance(exc, ValueError))
+
+        self.assertEqual([0, 2], results[0:3:2])
+        self.assertIsInstance(results[1], TypeError)
+        self.assertIsInstance(results[3], ValueError)
+        self.assertIsInstance(results[4], TaskCancelled)
+        self.assertIsInstance(results[5], TaskCancelled)
+
+    def test_no_fail_fast(self):
+        params = [{'num': num} for num in range(4)]
+        params[0]['exc'] = ValueError('failed')
+        results = list(self.run_task(parallelize=params, pool=self.pool,
+                                     stream=True))
+
+        self.assertIsInstance(results[0], ValueError)
+        self.assertEqual([1, 2, 3], results[1:])
+
+    def test_close_cancels(self):
+        results = self.run_task(
+            parallelize=[{'num': num, 'secs': 0.05} for num in range(10)],
+            n_workers=1, stream=True)
+        self.assertEqual(0, next(results))
+        results.close()
+
+        self.assertThat(len(self.ran), matchers.LessThan(4))
+
+
+class TestCasePipeline(TestCase):
+    def setUp(self):
+        super(TestCasePipeline, self).setUp()
+        self.useFixture(fixtures.MonkeyPatch('traceback.print_exc',
+                                             lambda: None))
+        self.pool = WorkerPool(2)
+        self.addCleanup(self.pool.shutdown)
+        self.produced = []
+
+    def produce(self, count, exc=None):
+        for num in range(count):
+            self.produced.append(num)
+            yield {'num': num}
+        if exc is not None:
+            raise exc
+
+    @staticmethod
+    def run_task(num):
+        if num == 3:
+            time.sleep(0.05)
+        return num
+
+    def test_results_in_order(self):
+        results = self.pool.pipeline(self.run_task, self.produce(10), 3)
+
+        self.assertEqual(list(range(10)), list(results))
+
+    def test_bounded_ahead(self):
+        consumed = []
+        for result in self.pool.pipeline(self.run_task, self.produce(20), 3):
+            consumed.append(result)
+            time.sleep(0.01)
+            self.assertThat(len(self.produced) - len(consumed),
+                            matchers.LessThan(4))
+
+        self.assertEqual(list(range(20)), consumed)
+
+    def test_producer_error_after_results(self):
+        results = self.pool.pipeline(
+            self.run_task, self.produce(4, ValueError('broken')), 2)
+
+        self.assertEqual([0, 1, 2, 3], [next(results) for _ in range(4)])
+        self.assertRaises(ValueError, next, results)
+
+    def test_close_stops_producing(self):
+        results = self.pool.pipeline(self.run_task, self.produce(100), 2)
+        self.assertEqual(0, next(results))
+        results.close()
+
+        self.assertThat(len(self.produced), matchers.LessThan(4))
+
+    def test_fail_fast(self):
+        def fail(num):
+            if num == 2:
+                raise ValueError(num)
+            return num
+
+        results = list(self.pool.pipeline(fail, self.produce(50), 2,
+                                          fail_fast=True))
+
+        self.assertEqual([0, 1], results[:2])
+        self.assertIsInstance(results[2], ValueError)
+        for result in results[3:]:
+            self.assertIsInstance(result, TaskCancelled)
+        self.assertThat(len(self.produced), matchers.LessThan(6))
+
+
+class TestCaseRunAdaptive(LoggingFixture, TestCase):
+    def test_correct_order(self):
+        def check(num):
+            if num == 7:
+                raise ValueError(num)
+            return num
+
+        result = run_adaptive(check, [{'num': num} for num in range(20)],
+                              max_workers=8, latency_target=1)
+        self.assertThat(result[:7], matchers.Equals(list(range(7))))
+        self.assertThat(result[7], matchers.IsInstance(ValueError))
+        self.assertThat(result[8:], matchers.Equals(list(range(8, 20))))
+
+    def test_limit_raised_under_target(self):
+        limiter = AdaptiveLimiter(max_limit=4, latency_target=1)
+        self.assertThat(limiter.limit, matchers.Equals(2))
+        for _ in range(20):
+            limiter.release(limiter.acquire())
+        self.assertThat(limiter.limit, matchers.Equals(4))
+
+    def test_limit_lowered_over_target(self):
+        limiter = AdaptiveLimiter(max_limit=16, latency_target=0.5, initial=8)
+        for _ in range(8):
+            limiter.release(limiter.acquire() - 1)
+        self.assertThat(limiter.limit, matchers.Equals(6))
+
+    def test_limit_halved_on_overload(self):
+        limiter = AdaptiveLimiter(max_limit=16, latency_target=1, initial=8)
+        limiter.release(limiter.acquire(), overloaded=True)
+        self.assertThat(limiter.limit, matchers.Equals(4))
+        limiter.release(limiter.acquire(), overloaded=True)
+        limiter.release(limiter.acquire(), overloaded=True)
+        limiter.release(limiter.acquire(), overloaded=True)
+        self.assertThat(limiter.limit, matchers.Equals(1))
+
+    def test_overload_backs_off(self):
+        def fail(num):
+            raise ValueError(num)
+
+        with mock.patch('jenkins_jobs.parallel.AdaptiveLimiter._set_limit',
+                        autospec=True,
+                        side_effect=AdaptiveLimiter._set_limit) as set_limit:
+            run_adaptive(fail, [{'num': num} for num in range(4)],
+                         max_workers=4, latency_target=1,
+                         is_overload=lambda exc: exc.args[0] % 2)
+        self.assertThat(
+            [c[0][2] for c in set_limit.call_args_list].count(
+                'overload reported'),
+            matchers.Equals(2))
+
+    @mock.patch('jenkins_jobs.parallel.time.sleep')
+    def test_transient_failures_retried(self, sleep_mock):
+        failures = {0: 2, 1: 5}
+
+        def flaky(num):
+            if failures.get(num):
+                failures[num] -= 1
+                raise ValueError(num)
+            return num
+
+        with mock.patch('jenkins_jobs.parallel.AdaptiveLimiter.release',
+                        autospec=True,
+                        side_effect=AdaptiveLimiter.release) as release:
+            result = run_adaptive(flaky, [{'num': num} for num in range(3)],
+                                  max_workers=1, latency_target=1,
+                                  is_overload=lambda exc: True, retries=3,
+                                  retry_delay=0.1,
+                                  is_transient=lambda exc: exc.args[0] < 2)
+        self.assertThat(result[0], matchers.Equals(0))
+        self.assertThat(result[1], matchers.IsInstance(ValueError))
+        self.assertThat(result[2], matchers.Equals(2))
+        # each failed attempt is reported as an overload
+        self.assertThat(
+            [c[0][2] for c in release.call_args_list if len(c[0]) > 2],
+            matchers.Equals([True] * 6))
+        self.assertThat(sleep_mock.call_count, matchers.Equals(5))
+
+    def test_max_rps(self):
+        before = time.time()
+        run_adaptive(lambda: None, [{} for _ in range(11)],
+                     max_workers=10, latency_target=1, max_rps=20)
+        after = time.time()
+        self.assertThat(after - before, matchers.GreaterThan(0.49))
+
+    def test_stats_logged(self):
+        logger = self.useFixture(fixtures.FakeLogger(level=logging.INFO))
+        run_adaptive(lambda: None, [{} for _ in range(5)],
+                     max_workers=2, latency_target=1)
+        self.assertThat(logger.output, matchers.Contains('Ran 5 tasks in '))
+        self.assertThat(logger.output,
+                        matchers.Contains('Tasks completed per second: 5'))
+        self.assertThat(logger.output, matchers.Contains(
+            'Latency histogram: <=0.1s: 5, <=0.25s: 0'))
@@ -0,0 +1,118 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from xml.dom import minidom
+import xml.etree.ElementTree as XML
+
+from testtools import TestCase
+
+from jenkins_jobs.errors import JenkinsJobsException
+from jenkins_jobs.xml_config import normalized_md5
+from jenkins_jobs.xml_config import XmlJob
+from tests.base import mock
+
+
+class TestCaseXmlJob(TestCase):
+
+    def _build_xml(self):
+        root = XML.Element('project')
+        XML.SubElement(root, 'empty')
+        XML.SubElement(root, 'blank').text = ''
+        desc = XML.SubElement(root, 'description')
+        desc.text = u'<b>"quoted" & unicode é</b>\r\nsecond line'
+        attrs = XML.SubElement(root, 'attrs', {'z': 'last', 'a': 'a & "b"'})
+        attrs.text = 'text'
+        mixed = XML.SubElement(root, 'mixed')
+        mixed.text = 'leading'
+        XML.SubElement(mixed, 'child').tail = 'tail'
+        XML.SubElement(XML.SubElement(mixed, 'nested'), 'deep').text = '1'
+        return root
+
+    def _minidom_output(self, xml):
+        # attributes are sorted by name as python versions before 3.8 did
+        for node in xml.iter():
+            items = sorted(node.attrib.items())
+            node.attrib.clear()
+            node.attrib.update(items)
+        out = minidom.parseString(XML.tostring(xml, encoding='UTF-8'))
+        return out.toprettyxml(indent='  ', encoding='utf-8')
+
+    def test_output_matches_minidom(self):
+        expected = self._minidom_output(self._build_xml())
+        self.assertEqual(expected, XmlJob(self._build_xml(), 'job').output())
+
+    def test_output_invalid_text(self):
+        root = XML.Element('project')
+        XML.SubElement(root, 'disabled').text = True
+        self.assertRaises(TypeError, XmlJob(root, 'job').output)
+
+    def test_output_invalid_character(self):
+        root = XML.Element('project')
+        XML.SubElement(root, 'command').text = u'echo \x1b[31mred\x1b[0m'
+        exc = self.assertRaises(JenkinsJobsException,
+                                XmlJob(root, 'colors').output)
+        self.assertIn("job 'colors'", str(exc))
+        self.assertIn("invalid XML character '\\x1b'", str(exc))
+
+    def test_output_invalid_attribute_character(self):
+        root = XML.Element('project', {'name': u'\x00'})
+        self.assertRaises(JenkinsJobsException, XmlJob(root, 'job').output)
+
+    @mock.patch('jenkins_jobs.xml_config._write_pretty')
+    def test_output_memoized(self, write_mock):
+        job = XmlJob(self._build_xml(), 'job')
+        job.md5()
+        job.output()
+        job.md5()
+        self.assertEqual(1, write_mock.call_count)
+
+    def test_output_invalidated(self):
+        job = XmlJob(self._build_xml(), 'job')
+        md5 = job.md5()
+
+        job.xml.find('empty').text = 'changed'
+        self.assertEqual(md5, job.md5())
+        job.invalidate()
+        changed_md5 = job.md5()
+        self.assertNotEqual(md5, changed_md5)
+
+        job.xml = self._build_xml()
+        self.assertEqual(md5, job.md5())
+
+
+class TestCaseNormalizedMd5(TestCase):
+
+    def test_formatting_ignored(self):
+        md5 = XmlJob(XML.fromstring(
+            '<project><description>text</description><builders>'
+            '<shell><command>ls\n  -l</command></shell></builders>'
+            '</project>'), 'job').normalized_md5()
+
+        self.assertEqual(md5, normalized_md5(
+            u"<?xml version='1.1' encoding='UTF-8'?>\n<project>\n"
+            u"    <description>text</description>\n    <builders>\n"
+            u"        <shell>\n            <command>ls\n  -l</command>\n"
+            u"        </shell>\n    </builders>\n</project>"))
+        self.assertEqual(md5, normalized_md5(
+            b'<project><description>text</description><builders><shell>'
+            b'<command>ls\r\n  -l</command></shell></builders></project>'))
+
+    def test_content_compared(self):
+        md5 = normalized_md5('<project><description>text</description>'
+                             '</project>')
+        for xml in ('<project><description>text </description></project>',
+                    '<project><description>other</description></project>',
+                    '<project><description a="b">text</description>'
+                    '</project>',
+                    '<project><description>text</description><disabled/>'
+                    '</project>'):
+            self.assertNotEqual(md5, normalized_md5(xml))
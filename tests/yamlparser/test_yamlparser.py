@@ -15,12 +15,21 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import copy
 import os
+import time
 
 from testscenarios.testcase import TestWithScenarios
+from testtools.content import text_content
+from testtools.matchers import StartsWith
 from testtools import TestCase
 
+from jenkins_jobs.modules import zuul
+from jenkins_jobs import parser as parser_module
+from jenkins_jobs.parser import YamlParser
 from tests.base import get_scenarios
+from tests.base import LoggingFixture
+from tests.base import mock
 from tests.base import SingleJobTestCase
 
 
@@ -28,3 +37,226 @@ class TestCaseModuleYamlInclude(TestWithScenarios,
                                 SingleJobTestCase, TestCase):
     fixtures_path = os.path.join(os.path.dirname(__file__), 'fixtures')
     scenarios = get_scenarios(fixtures_path)
+
+
+class TestCaseYamlParserDefaults(LoggingFixture, TestCase):
+
+    def _get_data(self, n_templates, n_values, n_jobs):
+        data = [{'defaults': {
+            'name': 'global',
+            'description': 'heavy defaults',
+            'builders': [{'shell': 'echo step %d' % n} for n in range(200)],
+            'publishers': [{'email': {'recipients': 'foo@example.com'}}],
+        }}]
+        for n in range(n_templates):
+            data.append({'job-template': {'name': 'template%d-{value}' % n}})
+        data.append({'project': {
+            'name': 'project',
+            'value': list(range(n_values)),
+            'jobs': ['template%d-{value}' % n for n in range(n_templates)],
+        }})
+        for n in range(n_jobs):
+            data.append({'job': {'name': 'job%d' % n}})
+        return data
+
+    def test_defaults_shared_across_expansions(self):
+        """
+        Microbenchmark expanding templates using large defaults, verifying
+        the defaults are only copied for the jobs not expanded from templates
+        """
+        parser = YamlParser()
+        parser.parse_data(self._get_data(50, 20, 10), 'defaults-heavy')
+
+        with mock.patch('jenkins_jobs.parser.copy.deepcopy',
+                        wraps=copy.deepcopy) as deepcopy_mock:
+            start = time.time()
+            parser.expandYaml()
+            elapsed = time.time() - start
+        self.addDetail('expand-time', text_content('%.3fs' % elapsed))
+
+        self.assertEqual(1010, len(parser.jobs))
+        self.assertEqual(10, deepcopy_mock.call_count)
+        self.assertEqual(200, len(parser.jobs[-1]['builders']))
+        self.assertIsNot(parser.jobs[-1]['builders'],
+                         parser.data['defaults']['global']['builders'])
+
+
+class TestCaseYamlParserJobsGlob(LoggingFixture, TestCase):
+
+    def _get_data(self):
+        return [
+            {'job-template': {'name': 'foo-{value}',
+                              'description': '{value} of {project}'}},
+            {'job-template': {'name': 'bar-{value}',
+                              'description': '{missing}'}},
+            {'project': {'name': 'project', 'value': list(range(20)),
+                         'project': '{name}',
+                         'jobs': ['foo-{value}', 'bar-{value}']}},
+        ]
+
+    def test_template_name_may_match(self):
+        may_match = parser_module.template_name_may_match
+        self.assertTrue(may_match('foo-{value}', ['foo-1']))
+        self.assertTrue(may_match('foo-{value}', ['*-1']))
+        self.assertTrue(may_match('foo-{value}', ['fo*']))
+        self.assertTrue(may_match('{project}-foo', ['bar-*']))
+        self.assertTrue(may_match('foo-{value}-bar', ['foo-?-bar']))
+        self.assertTrue(may_match('foo', ['f[aeiou]o']))
+        self.assertFalse(may_match('foo-{value}', ['bar-*']))
+        self.assertFalse(may_match('{value}-foo', ['*-bar']))
+        self.assertFalse(may_match('foo', ['foo-*']))
+        self.assertFalse(may_match('foo-{value}', []))
+
+    def test_template_name_may_match_escaped_braces(self):
+        may_match = parser_module.template_name_may_match
+        self.assertTrue(may_match('job-{{x}}', ['job-{x}']))
+        self.assertTrue(may_match('job-{{x}}-{value}', ['job-{x}-1']))
+        self.assertTrue(may_match('{value}-{{x}}', ['*-{x}']))
+        self.assertFalse(may_match('job-{{x}}', ['job-{']))
+        self.assertFalse(may_match('job-{{x}}-{value}', ['job-{y}-*']))
+        self.assertFalse(may_match('{value}-{{x}}', ['*-{y}']))
+
+    def test_jobs_glob_skips_non_matching_expansions(self):
+        """
+        Verify only the names of templates that can match are expanded when
+        filtering jobs, and the other fields only for the matching jobs
+        """
+        parser = YamlParser()
+        parser.parse_data(self._get_data(), 'jobs-glob')
+
+        with mock.patch('jenkins_jobs.parser.deep_format',
+                        wraps=parser_module.deep_format) as format_mock:
+            parser.expandYaml(jobs_glob=['foo-1*'])
+
+        self.assertEqual(['foo-1'] + ['foo-1%d' % n for n in range(10)],
+                         [job['name'] for job in parser.jobs])
+        self.assertTrue(
+            parser.jobs[1]['description'].startswith('10 of project'))
+        # one call per name of the foo template and per matching job
+        self.assertEqual(20 + 11, format_mock.call_count)
+
+
+class TestCaseYamlParserHandleData(LoggingFixture, TestCase):
+
+    def _get_data(self, n_jobs):
+        data = [
+            {'job': {'name': 'zuul-job', 'triggers': ['zuul']}},
+            {'job-template': {'name': 'zuul-post-{value}',
+                              'triggers': ['zuul-post']}},
+            {'project': {'name': 'project', 'value': [1, 2],
+                         'jobs': ['zuul-post-{value}']}},
+        ]
+        for n in range(n_jobs):
+            data.append({'job': {'name': 'job%d' % n,
+                                 'triggers': ['timed']}})
+        return data
+
+    def _add_module(self, parser, index, data_reads=None):
+        module = mock.Mock(spec=['handle_data', 'data_reads', 'data_writes'],
+                           data_reads=data_reads, data_writes=None)
+        module.handle_data.return_value = False
+        parser.registry.modules.insert(index, module)
+        return module
+
+    def test_revisit_changed_entries_only(self):
+        """
+        Verify modules declaring the sections they read only revisit the
+        entries changed since they last ran
+        """
+        parser = YamlParser()
+        parser.parse_data(self._get_data(100), 'handle-data')
+        # run before the zuul module, so see its changes on the next pass
+        views_module = self._add_module(parser, 0, data_reads=('view',))
+        jobs_module = self._add_module(parser, 0, data_reads=('job',))
+        other_module = self._add_module(parser, 0)
+        # run after the zuul module, so see its changes on the same pass
+        late_jobs_module = self._add_module(
+            parser, len(parser.registry.modules), data_reads=('job',))
+
+        visited = []
+
+        def changed_data(section):
+            entries = YamlParser.changed_data(parser, section)
+            visited.append((section, sorted(entries)))
+            return entries
+
+        with mock.patch.object(parser, 'changed_data',
+                               side_effect=changed_data):
+            parser.expandYaml()
+
+        self.assertEqual([('job', 101), ('job-template', 1),
+                          ('job', 1), ('job-template', 1)],
+                         [(section, len(names))
+                          for section, names in visited])
+        self.assertEqual([('job', ['zuul-job']),
+                          ('job-template', ['zuul-post-{value}'])],
+                         visited[2:])
+        self.assertEqual(1, views_module.handle_data.call_count)
+        self.assertEqual(2, jobs_module.handle_data.call_count)
+        self.assertEqual(2, other_module.handle_data.call_count)
+        self.assertEqual(1, late_jobs_module.handle_data.call_count)
+
+        jobs = dict((job['name'], job) for job in parser.jobs)
+        self.assertEqual([], jobs['zuul-job']['triggers'])
+        self.assertEqual(zuul.ZUUL_PARAMETERS, jobs['zuul-job']['parameters'])
+        self.assertEqual([], jobs['zuul-post-1']['triggers'])
+        self.assertEqual(zuul.ZUUL_POST_PARAMETERS,
+                         jobs['zuul-post-1']['parameters'])
+
+
+class TestCaseYamlParserGenerateXML(LoggingFixture, TestCase):
+
+    def _get_parser(self):
+        data = [
+            {'builder': {'name': 'echo-macro',
+                         'builders': [{'shell': 'echo {message}'}]}},
+            {'job-template': {
+                'name': '{name}-{value}', 'project-type': '{kind}',
+                'description': '{value} of {name}',
+                'builders': [{'echo-macro': {'message': '{value}'}}],
+                'publishers': [{'archive': {'artifacts': '*.log'}}]}},
+            {'project': {'name': 'freestyle', 'kind': 'freestyle',
+                         'value': list(range(30)),
+                         'jobs': ['{name}-{value}']}},
+            {'project': {'name': 'matrix', 'kind': 'matrix',
+                         'value': list(range(30)),
+                         'jobs': ['{name}-{value}']}},
+            {'job': {'name': 'unknown', 'project-type': 'unknown'}},
+        ]
+        parser = YamlParser()
+        parser.parse_data(data, 'generate-xml')
+        parser.expandYaml()
+        return parser
+
+    def test_process_pool_output(self):
+        """
+        Verify the jobs generated by worker processes are the same as those
+        generated serially, and in the same order
+        """
+        expected = self._get_parser()
+        expected.generateXML()
+        parser = self._get_parser()
+        parser.generateXML(n_workers=3)
+
+        self.assertEqual(61, len(parser.xml_jobs))
+        self.assertEqual(
+            [None if job is None else (job.name, job.output(), job.md5())
+             for job in expected.xml_jobs],
+            [None if job is None else (job.name, job.output(), job.md5())
+             for job in parser.xml_jobs])
+
+        # the trees are parsed back when needed
+        n_job = [job and job.name for job in parser.xml_jobs].index(
+            'matrix-1')
+        job = parser.xml_jobs[n_job]
+        self.assertThat(job.xml.find('description').text,
+                        StartsWith('1 of matrix'))
+        job.invalidate()
+        self.assertEqual(expected.xml_jobs[n_job].output(), job.output())
+
+    def test_serial_by_default(self):
+        parser = self._get_parser()
+        with mock.patch('multiprocessing.Pool') as pool_mock:
+            parser.generateXML()
+            parser.generateXML(n_workers=1)
+        self.assertFalse(pool_mock.called)